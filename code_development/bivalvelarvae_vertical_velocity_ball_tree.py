@@ -19,12 +19,12 @@
 import numpy as np
 from opendrift.models.oceandrift import OceanDrift, Lagrangian3DArray
 import logging; logger = logging.getLogger(__name__)
-#import shapefile
 from shapely.geometry import Polygon, Point, MultiPolygon # added for settlement in polygon only
 import fiona # to import habitat
+import shapely
 #import numba
 import random
-from sklearn.neighbors import BallTree
+from scipy.spatial import cKDTree
 
 
 # Defining the  element properties from Pelagicegg model
@@ -147,29 +147,39 @@ class BivalveLarvae(OceanDrift):
                            'description': 'maximum depth of the larvae',
                            'level': self.CONFIG_LEVEL_BASIC}})
         
+    def prepare_run(self):
+        '''Read once the settings used at every timestep, the configuration does not change during a run'''
+        super(BivalveLarvae, self).prepare_run()
+        self.min_settlement_age_seconds = float(self.get_config('drift:min_settlement_age_seconds'))
+        self.settlement_in_habitat = self.get_config('drift:settlement_in_habitat')
+        self.active_vertical_swimming = self.get_config('drift:active_vertical_swimming')
+        self.vertical_mixing_on = self.get_config('drift:vertical_mixing')
+        self.persistence = self.get_config('drift:persistence')
+        self.vertical_velocity = self.get_config('drift:vertical_velocity')
+        self.maximum_depth_limit = self.get_config('drift:maximum_depth')
+        self.max_age_seconds = self.get_config('drift:max_age_seconds')
+        self.time_step_seconds = self.time_step.total_seconds()
+
     def habitat(self, shapefile_location):
         """Suitable habitat in a shapefile"""
-        #global multiShp
-        #global shp # terrible idea, but works ok for the moment
-        #global bins
-        #shp = shapefile.Reader(shapefile_location)
-        #bins = shp.shapes()
-        #return shp, bins
-        polyShp = fiona.open(shapefile_location) # import shapefile
         polyList = []
         #polyProperties = []
-        centers = []
-        rad_centers = []
-        for poly in polyShp: # create individual polygons from shapefile
-             polyGeom = Polygon(poly['geometry']['coordinates'][0])
-             polyList.append(polyGeom) # Compile polygon in a list 
-             centers.append(polyGeom.centroid.coords[0]) # Compute centroid and return a [lon, lat] list
-             #polyProperties.append(poly['properties']) # For debugging => check if single polygon
-        for poly in range(len(centers)):
-            rad_centers.append([np.deg2rad(centers[poly][1]),np.deg2rad(centers[poly][0])])
+        with fiona.open(shapefile_location) as polyShp: # import shapefile, read in a single pass
+            for poly in polyShp: # create individual polygons from shapefile
+                 polyList.append(Polygon(poly['geometry']['coordinates'][0])) # Compile polygon in a list 
+                 #polyProperties.append(poly['properties']) # For debugging => check if single polygon
+        centers = shapely.get_coordinates(shapely.centroid(polyList)) # contiguous [lon, lat] float64 array of the centroids
         self.multiShp = MultiPolygon(polyList).buffer(0) # Aggregate polygons in a MultiPolygon object and buffer to fuse polygons and remove errors
-        self.ball_centers = BallTree(rad_centers, metric='haversine')
+        shapely.prepare(self.multiShp) # prepared geometry for the repeated point-in-polygon tests in interact_with_habitat
+        # KD Tree of the centroids on the unit sphere (euclidean chord distance on the sphere gives the same nearest neighbour as the great-circle distance)
+        self.ball_centers = cKDTree(self.unit_sphere_xyz(centers[:,0], centers[:,1]))
         return self.multiShp, self.ball_centers
+
+    # Cartesian coordinates on the unit sphere
+    def unit_sphere_xyz(self, lon, lat):
+        rlat = np.deg2rad(lat)
+        rlon = np.deg2rad(lon)
+        return np.column_stack((np.cos(rlat)*np.cos(rlon), np.cos(rlat)*np.sin(rlon), np.sin(rlat)))
     
     # # Haversine formula
     # #@numba.jit(nopython=True)
@@ -202,13 +212,10 @@ class BivalveLarvae(OceanDrift):
            sea_surface_height > 0 above mean sea level
            sea_surface_height < 0 below mean sea level
         '''
-        if hasattr(self, 'environment') and \
-                hasattr(self.environment, 'sea_surface_height'):
-            if len(self.environment.sea_surface_height) == \
-                    self.num_elements_active():
-                sea_surface_height = \
-                    self.environment.sea_surface_height
-        if 'sea_surface_height' not in locals():
+        # use the sea surface height already interpolated for the active elements if available
+        sea_surface_height = getattr(getattr(self, 'environment', None), 'sea_surface_height', None)
+        if sea_surface_height is None or \
+                len(sea_surface_height) != self.num_elements_active():
             env, env_profiles, missing = \
                 self.get_environment(['sea_surface_height'],
                                      time=self.time, lon=self.elements.lon,
@@ -228,29 +235,30 @@ class BivalveLarvae(OceanDrift):
         if 'sea_floor_depth_below_sea_level' not in self.priority_list:
             return
         sea_floor_depth = self.sea_floor_depth()
-        below = np.where(self.elements.z < -sea_floor_depth)[0]
-        if len(below) == 0:
+        sea_floor_z = -sea_floor_depth # seafloor elevation, negative down as z
+        below = self.elements.z < sea_floor_z
+        n_below = np.count_nonzero(below)
+        if n_below == 0:
                 logger.debug('No elements hit seafloor.')
                 return
 
-        below_and_older = np.logical_and(self.elements.z < -sea_floor_depth, 
-            self.elements.age_seconds >= self.get_config('drift:min_settlement_age_seconds'))
-        below_and_younger = np.logical_and(self.elements.z < -sea_floor_depth, 
-            self.elements.age_seconds < self.get_config('drift:min_settlement_age_seconds'))
+        older = self.elements.age_seconds >= self.min_settlement_age_seconds
+        below_and_older = below & older
+        below_and_younger = below & ~older
         
         # Move all elements younger back to seafloor 
         # (could rather be moved back to previous if relevant? )
-        self.elements.z[np.where(below_and_younger)] = -sea_floor_depth[np.where(below_and_younger)]
+        self.elements.z[below_and_younger] = sea_floor_z[below_and_younger]
 
         # deactivate elements that were both below and older
-        if self.get_config('drift:settlement_in_habitat') is False:
+        if self.settlement_in_habitat is False:
             self.deactivate_elements(below_and_older ,reason='settled_on_bottom')
         # if elements can only settle in habitat then they are moved back to seafloor
         else:
-            self.elements.z[np.where(below_and_older)] = -sea_floor_depth[np.where(below_and_older)]
+            self.elements.z[below_and_older] = sea_floor_z[below_and_older]
 
         logger.debug('%s elements hit seafloor, %s were older than %s sec. and deactivated, %s were lifted back to seafloor' \
-            % (len(below),len(below_and_older),self.get_config('drift:min_settlement_age_seconds'),len(below_and_younger)))    
+            % (n_below,np.count_nonzero(below_and_older),self.min_settlement_age_seconds,np.count_nonzero(below_and_younger)))    
 
 
     def surface_stick(self):
@@ -262,8 +270,8 @@ class BivalveLarvae(OceanDrift):
         sea_surface_height = self.sea_surface_height() # returns surface elevation at particle positions (>0 above msl, <0 below msl)
         
         # keep particle just below sea_surface_height (self.elements.z depth are negative down)
-        surface = np.where(self.elements.z >= sea_surface_height)
-        if len(surface[0]) > 0:
+        surface = self.elements.z >= sea_surface_height
+        if surface.any():
             self.elements.z[surface] = sea_surface_height[surface] -0.01 # set particle z at 0.01m below sea_surface_height
 
 
@@ -276,7 +284,7 @@ class BivalveLarvae(OceanDrift):
              if age_particle < min_settlement_age_seconds : move larvaes back to previous wet position
              if age_particle > min_settlement_age_seconds : larvaes become stranded and will be deactivated.
         """
-        i = self.get_config('general:coastline_action') # will always be 'previous'
+        #i = self.get_config('general:coastline_action') # will always be 'previous'
 
         if not hasattr(self.environment, 'land_binary_mask'):
             return
@@ -293,12 +301,13 @@ class BivalveLarvae(OceanDrift):
 
         # if i == 'previous':  # Go back to previous position (in water)
         # previous_position_if = self.previous_position_if()
+        on_land_mask = self.environment.land_binary_mask == 1 # elements on land, reused below
         if self.newly_seeded_IDs is not None:
                 self.deactivate_elements(
-                    (self.environment.land_binary_mask == 1) &
-                    (self.elements.age_seconds == self.time_step.total_seconds()),
+                    on_land_mask &
+                    np.isin(self.elements.ID, self.newly_seeded_IDs), # elements seeded at this timestep
                     reason='seeded_on_land')
-        on_land = np.where(self.environment.land_binary_mask == 1)[0]
+        on_land = np.flatnonzero(on_land_mask)
 
             # if previous_position_if is not None:
             #     self.deactivate_elements((previous_position_if*1 == 1) & (
@@ -313,32 +322,22 @@ class BivalveLarvae(OceanDrift):
         if len(on_land) == 0:
             logger.debug('No elements hit coastline.')
         else:
-            if self.get_config('drift:settlement_in_habitat') is True:
-                    # Particle can only settle in habitat, set back to previous location
-                    logger.debug('%s elements hit coastline, '
-                              'moving back to water' % len(on_land))
-                    on_land_ID = self.elements.ID[on_land]
-                    self.elements.lon[on_land] = \
-                        np.copy(self.previous_lon[on_land_ID - 1])
-                    self.elements.lat[on_land] = \
-                        np.copy(self.previous_lat[on_land_ID - 1])
-                    self.environment.land_binary_mask[on_land] = 0  
-            elif self.get_config('drift:min_settlement_age_seconds') == 0.0 :
-                # No minimum age input, set back to previous position (same as in interact_with_coastline() from basemodel.py)
+            if self.settlement_in_habitat is True or self.min_settlement_age_seconds == 0.0 :
+                # Particle can only settle in habitat, or no minimum age input: set back to previous position
+                # (same as in interact_with_coastline() from basemodel.py)
                 logger.debug('%s elements hit coastline, '
                           'moving back to water' % len(on_land))
-                on_land_ID = self.elements.ID[on_land]
-                self.elements.lon[on_land] = \
-                    np.copy(self.previous_lon[on_land_ID - 1])
-                self.elements.lat[on_land] = \
-                    np.copy(self.previous_lat[on_land_ID - 1])
+                previous_index = self.elements.ID[on_land] - 1 # index of the previous positions of the elements
+                self.elements.lon[on_land] = self.previous_lon[previous_index]
+                self.elements.lat[on_land] = self.previous_lat[previous_index]
                 self.environment.land_binary_mask[on_land] = 0
             else:
                 #################################
                 # Minimum age before settling was input; check age of particle versus min_settlement_age_seconds
                 # and strand or recirculate accordingly
-                on_land_and_younger = np.where((self.environment.land_binary_mask == 1) & (self.elements.age_seconds < self.get_config('drift:min_settlement_age_seconds')))[0]
-                on_land_and_older = np.where((self.environment.land_binary_mask == 1) & (self.elements.age_seconds >= self.get_config('drift:min_settlement_age_seconds')))[0]
+                older = self.elements.age_seconds >= self.min_settlement_age_seconds
+                on_land_and_younger = np.flatnonzero(on_land_mask & ~older)
+                on_land_and_older = np.flatnonzero(on_land_mask & older)
 
                 # this step replicates what is done is original code, but accounting for particle age. It seems necessary 
                 # to have an array of ID, rather than directly indexing using the "np.where-type" index (in dint64)
@@ -347,7 +346,7 @@ class BivalveLarvae(OceanDrift):
 
                 logger.debug('%s elements hit coastline' % len(on_land))
                 logger.debug('moving %s elements younger than min_settlement_age_seconds back to previous water position' % len(on_land_and_younger))
-                logger.debug('%s elements older than min_settlement_age_seconds remain stranded on coast' % len(on_land_and_younger))
+                logger.debug('%s elements older than min_settlement_age_seconds remain stranded on coast' % len(on_land_and_older))
                 
                 # refloat elements younger than min_settlement_age back to previous position(s)
                 if len(on_land_and_younger) > 0 :
@@ -355,22 +354,21 @@ class BivalveLarvae(OceanDrift):
                     # self.elements.lat[np.where(on_land_and_younger)] = np.copy(self.previous_lat[np.where(on_land_and_younger)])
                     # self.environment.land_binary_mask[on_land_and_younger] = 0 
 
-                    self.elements.lon[on_land_and_younger] = np.copy(self.previous_lon[on_land_and_younger_ID - 1])
-                    self.elements.lat[on_land_and_younger] = np.copy(self.previous_lat[on_land_and_younger_ID - 1])
+                    previous_index = on_land_and_younger_ID - 1
+                    self.elements.lon[on_land_and_younger] = self.previous_lon[previous_index]
+                    self.elements.lat[on_land_and_younger] = self.previous_lat[previous_index]
                     self.environment.land_binary_mask[on_land_and_younger] = 0
 
                 # deactivate elements older than min_settlement_age & save position
                 # ** function expects an array of size consistent with self.elements.lon
-                self.deactivate_elements((self.environment.land_binary_mask == 1) & \
-                                         (self.elements.age_seconds >= self.get_config('drift:min_settlement_age_seconds')),
-                                         reason='settled_on_coast')
+                self.deactivate_elements(on_land_mask & older, reason='settled_on_coast')
     
     def interact_with_habitat(self):
            """Habitat interaction according to configuration setting
                The method checks if a particle is within the limit of an habitat before to allow settlement
            """        
            # Get age of particle
-           old_enough = np.where(self.elements.age_seconds >= self.get_config('drift:min_settlement_age_seconds'))[0]
+           old_enough = np.where(self.elements.age_seconds >= self.min_settlement_age_seconds)[0]
            # Extract particles positions
            if len(old_enough) > 0 :
                pts_lon = self.elements.lon[old_enough]
@@ -385,11 +383,9 @@ class BivalveLarvae(OceanDrift):
                #        if in_habitat == True:
                #            #import pdb; pdb.set_trace()
                #            self.environment.land_binary_mask[old_enough[i]] = 6
-               for i in range(len(pts_lon)): # => faster version
-                    pt = Point(pts_lon[i], pts_lat[i])
-                    in_habitat = pt.within(self.multiShp)
-                    if in_habitat == True:
-                        self.environment.land_binary_mask[old_enough[i]] = 6
+               # Check all particles at once against the prepared habitat geometry
+               in_habitat = shapely.contains_xy(self.multiShp, pts_lon, pts_lat)
+               self.environment.land_binary_mask[old_enough[in_habitat]] = 6
                         
            # Deactivate elements that are within a polygon and old enough to settle
            # ** function expects an array of size consistent with self.elements.lon                
@@ -400,15 +396,18 @@ class BivalveLarvae(OceanDrift):
            """"Vertical movements of the larvae when caught in inshore currents: larvae try to stay within the currents that move
            them closer to shore, otherwise the larvae go up and down to sample the water column
            """
-           # Check distance with nearest_habitat using the Ball tree algorithm
-           dist_old = self.ball_centers.query(list(zip(np.deg2rad(self.previous_lat), np.deg2rad(self.previous_lon))), k=1)
-           dist = self.ball_centers.query(list(zip(np.deg2rad(self.elements.lat), np.deg2rad(self.elements.lon))), k=1)
+           # Check distance with nearest_habitat using the KD tree (chord distances, which rank like great-circle distances)
+           # (previous positions are stored by element ID, so they are gathered for the active elements)
+           previous_index = self.elements.ID - 1
+           dist_old = self.ball_centers.query(self.unit_sphere_xyz(self.previous_lon[previous_index], self.previous_lat[previous_index]), k=1, workers=-1)
+           dist = self.ball_centers.query(self.unit_sphere_xyz(self.elements.lon, self.elements.lat), k=1, workers=-1)
+           vertical_step = self.vertical_velocity * self.time_step_seconds # vertical displacement over the timestep
            for i in range(len(self.elements.lat)):
                if dist[0][i] > dist_old[0][i]:
                    rand = random.uniform(0,1)
-                   movementr = self.elements.vertical_movement[i] if rand > 1/(2+self.get_config('drift:persistence')) else -1 if random.uniform(0,1) < 0.5 else 1 # Correlated random walk
+                   movementr = self.elements.vertical_movement[i] if rand > 1/(2+self.persistence) else -1 if random.uniform(0,1) < 0.5 else 1 # Correlated random walk
                    self.elements.vertical_movement[i] = movementr      
-                   self.elements.z[i] = self.elements.z[i] + movementr*self.get_config('drift:vertical_velocity') * self.time_step.total_seconds()
+                   self.elements.z[i] = self.elements.z[i] + movementr*vertical_step
                    # Good, but some particles fly above water: the following code fixes that and reorients the larvae to swim down
                    sea_surface_height = self.sea_surface_height()[i] # returns surface elevation at particle positions (>0 above msl, <0 below msl)
                    # keep particle just below sea_surface_height (self.elements.z depth are negative down)
@@ -416,8 +415,8 @@ class BivalveLarvae(OceanDrift):
                       self.elements.z[i] = sea_surface_height - 0.01 # set particle z at 0.01m below sea_surface_height
                       self.elements.vertical_movement[i] = - abs(movementr)
                       #import pdb; pdb.set_trace()
-                   if self.get_config('drift:maximum_depth') is not None:
-                      if self.elements.z[i] <= self.get_config('drift:maximum_depth'):
+                   if self.maximum_depth_limit is not None:
+                      if self.elements.z[i] <= self.maximum_depth_limit:
                           self.elements.vertical_movement[i] = + abs(movementr)
                else:
                    pass
@@ -425,10 +424,10 @@ class BivalveLarvae(OceanDrift):
                
     def maximum_depth(self):
            '''Turn around larvae that are going too deep'''
-           if self.get_config('drift:maximum_depth') is not None:
-                too_deep = np.where(self.elements.z < self.get_config('drift:maximum_depth'))[0]
+           if self.maximum_depth_limit is not None:
+                too_deep = np.where(self.elements.z < self.maximum_depth_limit)[0]
                 if len(too_deep) > 0:
-                    self.elements.z[too_deep] = self.get_config('drift:maximum_depth')
+                    self.elements.z[too_deep] = self.maximum_depth_limit
         
     
     def increase_age_and_retire(self):  # ##So that if max_age_seconds is exceeded particle is flagged as died
@@ -439,25 +438,27 @@ class BivalveLarvae(OceanDrift):
                .. could probably be removed...
             """
             # Increase age of elements
-            self.elements.age_seconds += self.time_step.total_seconds()
+            self.elements.age_seconds += self.time_step_seconds
 
             # Deactivate elements that exceed a certain age
-            if self.get_config('drift:max_age_seconds') is not None:
+            if self.max_age_seconds is not None:
                 self.deactivate_elements(self.elements.age_seconds >=
-                                         self.get_config('drift:max_age_seconds'),
+                                         self.max_age_seconds,
                                          reason='died')
 
             # Deacticate any elements outside validity domain set by user
             if self.validity_domain is not None:
                 W, E, S, N = self.validity_domain
+                outside = np.zeros(len(self.elements.lon), dtype=bool)
                 if W is not None:
-                    self.deactivate_elements(self.elements.lon < W, reason='outside')
+                    outside |= self.elements.lon < W
                 if E is not None:
-                    self.deactivate_elements(self.elements.lon > E, reason='outside')
+                    outside |= self.elements.lon > E
                 if S is not None:
-                    self.deactivate_elements(self.elements.lat < S, reason='outside')
+                    outside |= self.elements.lat < S
                 if N is not None:
-                    self.deactivate_elements(self.elements.lat > N, reason='outside')
+                    outside |= self.elements.lat > N
+                self.deactivate_elements(outside, reason='outside')
                     
  
     def update(self):
@@ -471,11 +472,11 @@ class BivalveLarvae(OceanDrift):
         self.advect_ocean_current()
 
         # Check for presence in habitat
-        if self.get_config('drift:settlement_in_habitat') is True:
+        if self.settlement_in_habitat is True:
             self.interact_with_habitat()
 
         # Turbulent Mixing or settling-only 
-        if self.get_config('drift:vertical_mixing') is True:
+        if self.vertical_mixing_on is True:
             self.update_terminal_velocity()  #compute vertical velocities, two cases possible - constant, or same as pelagic egg
             self.vertical_mixing()
         else:  # Buoyancy
@@ -483,7 +484,7 @@ class BivalveLarvae(OceanDrift):
             self.update_terminal_velocity()
             self.vertical_buoyancy()
 
-        if self.get_config('drift:active_vertical_swimming') is True:
+        if self.active_vertical_swimming is True:
             self.vertical_swimming()
 
         self.vertical_advection()
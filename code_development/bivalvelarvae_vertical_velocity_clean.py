@@ -21,7 +21,25 @@ from opendrift.models.oceandrift import OceanDrift, Lagrangian3DArray
 import logging; logger = logging.getLogger(__name__)
 from shapely.geometry import Polygon, Point, MultiPolygon # added for settlement in polygon only
 import fiona # to import habitat
+import shapely
 import random
+from scipy.spatial import cKDTree
+import math
+import numba
+
+
+# Haversine formula (distance in km) to a habitat centroid given in radians, with the cosine of its latitude precomputed,
+# compiled as a ufunc (computed in double precision for float32 positions)
+@numba.vectorize(['float64(float64, float64, float64, float64, float64)', 'float32(float32, float32, float32, float32, float32)'], target='parallel', fastmath=True)
+def _haversine_distance_centroid(s_lng, s_lat, e_lng_rad, e_lat_rad, cos_e_lat):
+    # approximate radius of earth in km
+    R = 6373.0
+    s_lat = math.radians(float(s_lat))
+    e_lat_rad = float(e_lat_rad)
+    d = math.sin((e_lat_rad - s_lat)/2)**2 + \
+        math.cos(s_lat)*float(cos_e_lat) * \
+        math.sin((float(e_lng_rad) - math.radians(float(s_lng)))/2)**2
+    return 2 * R * math.asin(math.sqrt(d))
 
 
 # Defining the  element properties from Pelagicegg model
@@ -142,37 +160,48 @@ class BivalveLarvae(OceanDrift):
                            'description': 'maximum depth of the larvae',
                            'level': self.CONFIG_LEVEL_BASIC}})
         
+    def prepare_run(self):
+        '''Read once the settings used at every timestep, the configuration does not change during a run'''
+        super(BivalveLarvae, self).prepare_run()
+        self.min_settlement_age_seconds = float(self.get_config('drift:min_settlement_age_seconds'))
+        self.settlement_in_habitat = self.get_config('drift:settlement_in_habitat')
+        self.active_vertical_swimming = self.get_config('drift:active_vertical_swimming')
+        self.vertical_mixing_on = self.get_config('drift:vertical_mixing')
+        self.persistence = self.get_config('drift:persistence')
+        self.vertical_velocity = self.get_config('drift:vertical_velocity')
+        self.maximum_depth_limit = self.get_config('drift:maximum_depth')
+        self.max_age_seconds = self.get_config('drift:max_age_seconds')
+        self.time_step_seconds = self.time_step.total_seconds()
+
     def habitat(self, shapefile_location):
         """Suitable habitat in a shapefile"""
-        polyShp = fiona.open(shapefile_location) # import shapefile
         polyList = []
-        self.centers = []
-        for poly in polyShp: # create individual polygons from shapefile
-             polyGeom = Polygon(poly['geometry']['coordinates'][0])
-             polyList.append(polyGeom) # Compile polygon in a list 
-             self.centers.append(polyGeom.centroid.coords[0]) # Compute centroid and return a [lon, lat] list
+        with fiona.open(shapefile_location) as polyShp: # import shapefile, read in a single pass
+            for poly in polyShp: # create individual polygons from shapefile
+                 polyList.append(Polygon(poly['geometry']['coordinates'][0])) # Compile polygon in a list 
+        self.centers = shapely.get_coordinates(shapely.centroid(polyList)) # contiguous [lon, lat] float64 array of the centroids
+        # Centroids in radians and cosine of their latitude, computed once for all the distances to the habitat
+        # (stored in float32 like the particle positions, so the distances use the float32 ufunc loop)
+        self.centers_lon_rad = np.radians(self.centers[:,0]).astype(np.float32)
+        self.centers_lat_rad = np.radians(self.centers[:,1]).astype(np.float32)
+        self.centers_coslat = np.cos(np.radians(self.centers[:,1])).astype(np.float32)
         self.multiShp = MultiPolygon(polyList).buffer(0) # Aggregate polygons in a MultiPolygon object and buffer to fuse polygons and remove errors
+        shapely.prepare(self.multiShp) # prepared geometry for the repeated point-in-polygon tests in interact_with_habitat
+        # KD Tree of the centroids on the unit sphere (euclidean chord distance on the sphere gives the same nearest neighbour as the great-circle distance)
+        self.habitat_tree = cKDTree(self.unit_sphere_xyz(self.centers[:,0], self.centers[:,1]))
         return self.multiShp, self.centers
-    
-    # Haversine formula
-    #@numba.jit(nopython=True)
-    def haversine_distance(self, s_lng, s_lat, e_lng, e_lat):
-         # approximate radius of earth in km
-         R = 6373.0
-         s_lat = np.deg2rad(s_lat)                    
-         s_lng = np.deg2rad(s_lng)     
-         e_lat = np.deg2rad(e_lat)                       
-         e_lng = np.deg2rad(e_lng)
-         d = np.sin((e_lat - s_lat)/2)**2 + \
-             np.cos(s_lat)*np.cos(e_lat) * \
-             np.sin((e_lng - s_lng)/2)**2
-         return 2 * R * np.arcsin(np.sqrt(d))
+
+    # Cartesian coordinates on the unit sphere
+    def unit_sphere_xyz(self, lon, lat):
+        rlat = np.deg2rad(lat)
+        rlon = np.deg2rad(lon)
+        return np.column_stack((np.cos(rlat)*np.cos(rlon), np.cos(rlat)*np.sin(rlon), np.sin(rlat)))
      
-    def nearest_habitat(self, lon, lat, centers):
-         dist = np.zeros(len(centers))
-         dist = self.haversine_distance(lon, lat, [centers[0] for centers in centers], [centers[1] for centers in centers])
-         nearest_center = np.argmin(dist)
-         return nearest_center, min(dist)
+    def nearest_habitat(self, lon, lat):
+         '''Index of and distance (km) to the nearest habitat centroid, for all positions at once'''
+         _, nearest_center = self.habitat_tree.query(self.unit_sphere_xyz(lon, lat), k=1, workers=-1)
+         dist = _haversine_distance_centroid(lon, lat, self.centers_lon_rad[nearest_center], self.centers_lat_rad[nearest_center], self.centers_coslat[nearest_center])
+         return nearest_center, dist
 
     #def update_terminal_velocity(self, Tprofiles=None,
     #                             Sprofiles=None, z_index=None):
@@ -184,13 +213,10 @@ class BivalveLarvae(OceanDrift):
            sea_surface_height > 0 above mean sea level
            sea_surface_height < 0 below mean sea level
         '''
-        if hasattr(self, 'environment') and \
-                hasattr(self.environment, 'sea_surface_height'):
-            if len(self.environment.sea_surface_height) == \
-                    self.num_elements_active():
-                sea_surface_height = \
-                    self.environment.sea_surface_height
-        if 'sea_surface_height' not in locals():
+        # use the sea surface height already interpolated for the active elements if available
+        sea_surface_height = getattr(getattr(self, 'environment', None), 'sea_surface_height', None)
+        if sea_surface_height is None or \
+                len(sea_surface_height) != self.num_elements_active():
             env, env_profiles, missing = \
                 self.get_environment(['sea_surface_height'],
                                      time=self.time, lon=self.elements.lon,
@@ -212,29 +238,30 @@ class BivalveLarvae(OceanDrift):
         if 'sea_floor_depth_below_sea_level' not in self.priority_list:
             return
         sea_floor_depth = self.sea_floor_depth()
-        below = np.where(self.elements.z < -sea_floor_depth)[0]
-        if len(below) == 0:
+        sea_floor_z = -sea_floor_depth # seafloor elevation, negative down as z
+        below = self.elements.z < sea_floor_z
+        n_below = np.count_nonzero(below)
+        if n_below == 0:
                 logger.debug('No elements hit seafloor.')
                 return
 
-        below_and_older = np.logical_and(self.elements.z < -sea_floor_depth, 
-            self.elements.age_seconds >= self.get_config('drift:min_settlement_age_seconds'))
-        below_and_younger = np.logical_and(self.elements.z < -sea_floor_depth, 
-            self.elements.age_seconds < self.get_config('drift:min_settlement_age_seconds'))
+        older = self.elements.age_seconds >= self.min_settlement_age_seconds
+        below_and_older = below & older
+        below_and_younger = below & ~older
         
         # Move all elements younger back to seafloor 
         # (could rather be moved back to previous if relevant? )
-        self.elements.z[np.where(below_and_younger)] = -sea_floor_depth[np.where(below_and_younger)]
+        self.elements.z[below_and_younger] = sea_floor_z[below_and_younger]
 
         # deactivate elements that were both below and older
-        if self.get_config('drift:settlement_in_habitat') is False:
+        if self.settlement_in_habitat is False:
             self.deactivate_elements(below_and_older ,reason='settled_on_bottom')
         # if elements can only settle in habitat then they are moved back to seafloor
         else:
-            self.elements.z[np.where(below_and_older)] = -sea_floor_depth[np.where(below_and_older)]
+            self.elements.z[below_and_older] = sea_floor_z[below_and_older]
 
         logger.debug('%s elements hit seafloor, %s were older than %s sec. and deactivated, %s were lifted back to seafloor' \
-            % (len(below),len(below_and_older),self.get_config('drift:min_settlement_age_seconds'),len(below_and_younger)))    
+            % (n_below,np.count_nonzero(below_and_older),self.min_settlement_age_seconds,np.count_nonzero(below_and_younger)))    
 
 
     def surface_stick(self):
@@ -246,8 +273,8 @@ class BivalveLarvae(OceanDrift):
         sea_surface_height = self.sea_surface_height() # returns surface elevation at particle positions (>0 above msl, <0 below msl)
         
         # keep particle just below sea_surface_height (self.elements.z depth are negative down)
-        surface = np.where(self.elements.z >= sea_surface_height)
-        if len(surface[0]) > 0:
+        surface = self.elements.z >= sea_surface_height
+        if surface.any():
             self.elements.z[surface] = sea_surface_height[surface] -0.01 # set particle z at 0.01m below sea_surface_height
 
 
@@ -260,7 +287,7 @@ class BivalveLarvae(OceanDrift):
              if age_particle < min_settlement_age_seconds : move larvaes back to previous wet position
              if age_particle > min_settlement_age_seconds : larvaes become stranded and will be deactivated.
         """
-        i = self.get_config('general:coastline_action') # will always be 'previous'
+        #i = self.get_config('general:coastline_action') # will always be 'previous'
 
         if not hasattr(self.environment, 'land_binary_mask'):
             return
@@ -277,12 +304,13 @@ class BivalveLarvae(OceanDrift):
 
         # if i == 'previous':  # Go back to previous position (in water)
         # previous_position_if = self.previous_position_if()
+        on_land_mask = self.environment.land_binary_mask == 1 # elements on land, reused below
         if self.newly_seeded_IDs is not None:
                 self.deactivate_elements(
-                    (self.environment.land_binary_mask == 1) &
-                    (self.elements.age_seconds == self.time_step.total_seconds()),
+                    on_land_mask &
+                    np.isin(self.elements.ID, self.newly_seeded_IDs), # elements seeded at this timestep
                     reason='seeded_on_land')
-        on_land = np.where(self.environment.land_binary_mask == 1)[0]
+        on_land = np.flatnonzero(on_land_mask)
 
             # if previous_position_if is not None:
             #     self.deactivate_elements((previous_position_if*1 == 1) & (
@@ -297,32 +325,22 @@ class BivalveLarvae(OceanDrift):
         if len(on_land) == 0:
             logger.debug('No elements hit coastline.')
         else:
-            if self.get_config('drift:settlement_in_habitat') is True:
-                    # Particle can only settle in habitat, set back to previous location
-                    logger.debug('%s elements hit coastline, '
-                              'moving back to water' % len(on_land))
-                    on_land_ID = self.elements.ID[on_land]
-                    self.elements.lon[on_land] = \
-                        np.copy(self.previous_lon[on_land_ID - 1])
-                    self.elements.lat[on_land] = \
-                        np.copy(self.previous_lat[on_land_ID - 1])
-                    self.environment.land_binary_mask[on_land] = 0  
-            elif self.get_config('drift:min_settlement_age_seconds') == 0.0 :
-                # No minimum age input, set back to previous position (same as in interact_with_coastline() from basemodel.py)
+            if self.settlement_in_habitat is True or self.min_settlement_age_seconds == 0.0 :
+                # Particle can only settle in habitat, or no minimum age input: set back to previous position
+                # (same as in interact_with_coastline() from basemodel.py)
                 logger.debug('%s elements hit coastline, '
                           'moving back to water' % len(on_land))
-                on_land_ID = self.elements.ID[on_land]
-                self.elements.lon[on_land] = \
-                    np.copy(self.previous_lon[on_land_ID - 1])
-                self.elements.lat[on_land] = \
-                    np.copy(self.previous_lat[on_land_ID - 1])
+                previous_index = self.elements.ID[on_land] - 1 # index of the previous positions of the elements
+                self.elements.lon[on_land] = self.previous_lon[previous_index]
+                self.elements.lat[on_land] = self.previous_lat[previous_index]
                 self.environment.land_binary_mask[on_land] = 0
             else:
                 #################################
                 # Minimum age before settling was input; check age of particle versus min_settlement_age_seconds
                 # and strand or recirculate accordingly
-                on_land_and_younger = np.where((self.environment.land_binary_mask == 1) & (self.elements.age_seconds < self.get_config('drift:min_settlement_age_seconds')))[0]
-                on_land_and_older = np.where((self.environment.land_binary_mask == 1) & (self.elements.age_seconds >= self.get_config('drift:min_settlement_age_seconds')))[0]
+                older = self.elements.age_seconds >= self.min_settlement_age_seconds
+                on_land_and_younger = np.flatnonzero(on_land_mask & ~older)
+                on_land_and_older = np.flatnonzero(on_land_mask & older)
 
                 # this step replicates what is done is original code, but accounting for particle age. It seems necessary 
                 # to have an array of ID, rather than directly indexing using the "np.where-type" index (in dint64)
@@ -331,7 +349,7 @@ class BivalveLarvae(OceanDrift):
 
                 logger.debug('%s elements hit coastline' % len(on_land))
                 logger.debug('moving %s elements younger than min_settlement_age_seconds back to previous water position' % len(on_land_and_younger))
-                logger.debug('%s elements older than min_settlement_age_seconds remain stranded on coast' % len(on_land_and_younger))
+                logger.debug('%s elements older than min_settlement_age_seconds remain stranded on coast' % len(on_land_and_older))
                 
                 # refloat elements younger than min_settlement_age back to previous position(s)
                 if len(on_land_and_younger) > 0 :
@@ -339,31 +357,28 @@ class BivalveLarvae(OceanDrift):
                     # self.elements.lat[np.where(on_land_and_younger)] = np.copy(self.previous_lat[np.where(on_land_and_younger)])
                     # self.environment.land_binary_mask[on_land_and_younger] = 0 
 
-                    self.elements.lon[on_land_and_younger] = np.copy(self.previous_lon[on_land_and_younger_ID - 1])
-                    self.elements.lat[on_land_and_younger] = np.copy(self.previous_lat[on_land_and_younger_ID - 1])
+                    previous_index = on_land_and_younger_ID - 1
+                    self.elements.lon[on_land_and_younger] = self.previous_lon[previous_index]
+                    self.elements.lat[on_land_and_younger] = self.previous_lat[previous_index]
                     self.environment.land_binary_mask[on_land_and_younger] = 0
 
                 # deactivate elements older than min_settlement_age & save position
                 # ** function expects an array of size consistent with self.elements.lon
-                self.deactivate_elements((self.environment.land_binary_mask == 1) & \
-                                         (self.elements.age_seconds >= self.get_config('drift:min_settlement_age_seconds')),
-                                         reason='settled_on_coast')
+                self.deactivate_elements(on_land_mask & older, reason='settled_on_coast')
     
     def interact_with_habitat(self):
            """Habitat interaction according to configuration setting
                The method checks if a particle is within the limit of an habitat before to allow settlement
            """        
            # Get age of particle
-           old_enough = np.where(self.elements.age_seconds >= self.get_config('drift:min_settlement_age_seconds'))[0]
+           old_enough = np.where(self.elements.age_seconds >= self.min_settlement_age_seconds)[0]
            # Extract particles positions
            if len(old_enough) > 0 :
                pts_lon = self.elements.lon[old_enough]
                pts_lat = self.elements.lat[old_enough]
-               for i in range(len(pts_lon)): # => faster version
-                    pt = Point(pts_lon[i], pts_lat[i])
-                    in_habitat = pt.within(self.multiShp)
-                    if in_habitat == True:
-                        self.environment.land_binary_mask[old_enough[i]] = 6
+               # Check all particles at once against the prepared habitat geometry
+               in_habitat = shapely.contains_xy(self.multiShp, pts_lon, pts_lat)
+               self.environment.land_binary_mask[old_enough[in_habitat]] = 6
                         
            # Deactivate elements that are within a polygon and old enough to settle
            # ** function expects an array of size consistent with self.elements.lon                
@@ -374,19 +389,17 @@ class BivalveLarvae(OceanDrift):
            """"Vertical movements of the larvae when caught in inshore currents: larvae try to stay within the currents that move
            them closer to shore, otherwise the larvae go up and down to sample the water column
            """
-           # Check distance with nearest_habitat
-           pts_lon = self.elements.lon
-           pts_lat = self.elements.lat
-           pts_lon_old = self.previous_lon
-           pts_lat_old = self.previous_lat
-           for i in range(len(pts_lon)):
-               dist_old = self.nearest_habitat(pts_lon_old[i], pts_lat_old[i], self.centers)     
-               dist = self.nearest_habitat(pts_lon[i], pts_lat[i], self.centers)
-               if dist_old < dist:
+           # Check distance with nearest_habitat, for all particles at once
+           # (previous positions are stored by element ID, so they are gathered for the active elements)
+           previous_index = self.elements.ID - 1
+           _, dist_old = self.nearest_habitat(self.previous_lon[previous_index], self.previous_lat[previous_index])
+           _, dist = self.nearest_habitat(self.elements.lon, self.elements.lat)
+           for i in range(len(self.elements.lon)):
+               if dist_old[i] < dist[i]:
                    rand = random.uniform(0,1)
-                   movementr = self.elements.vertical_movement[i] if rand > 1/(2+self.get_config('drift:persistence')) else -1 if random.uniform(0,1) < 0.5 else 1 # Correlated random walk
+                   movementr = self.elements.vertical_movement[i] if rand > 1/(2+self.persistence) else -1 if random.uniform(0,1) < 0.5 else 1 # Correlated random walk
                    self.elements.vertical_movement[i] = movementr      
-                   self.elements.z[i] = self.elements.z[i] + movementr*self.get_config('drift:vertical_velocity')
+                   self.elements.z[i] = self.elements.z[i] + movementr*self.vertical_velocity
                    # Good, but some particles fly above water: the following code fixes that and reorients the larvae to swim down
                    sea_surface_height = self.sea_surface_height()[i] # returns surface elevation at particle positions (>0 above msl, <0 below msl)
                    # keep particle just below sea_surface_height (self.elements.z depth are negative down)
@@ -399,10 +412,10 @@ class BivalveLarvae(OceanDrift):
                    
     def maximum_depth(self):
            '''Turn around larvae that are going too deep'''
-           if self.get_config('drift:maximum_depth') is not None:
-                too_deep = np.where(self.elements.z < self.get_config('drift:maximum_depth'))[0]
+           if self.maximum_depth_limit is not None:
+                too_deep = np.where(self.elements.z < self.maximum_depth_limit)[0]
                 if len(too_deep) > 0:
-                    self.elements.z[too_deep] = self.get_config('drift:maximum_depth')
+                    self.elements.z[too_deep] = self.maximum_depth_limit
         
     
     def increase_age_and_retire(self):  # ##So that if max_age_seconds is exceeded particle is flagged as died
@@ -413,25 +426,27 @@ class BivalveLarvae(OceanDrift):
                .. could probably be removed...
             """
             # Increase age of elements
-            self.elements.age_seconds += self.time_step.total_seconds()
+            self.elements.age_seconds += self.time_step_seconds
 
             # Deactivate elements that exceed a certain age
-            if self.get_config('drift:max_age_seconds') is not None:
+            if self.max_age_seconds is not None:
                 self.deactivate_elements(self.elements.age_seconds >=
-                                         self.get_config('drift:max_age_seconds'),
+                                         self.max_age_seconds,
                                          reason='died')
 
             # Deacticate any elements outside validity domain set by user
             if self.validity_domain is not None:
                 W, E, S, N = self.validity_domain
+                outside = np.zeros(len(self.elements.lon), dtype=bool)
                 if W is not None:
-                    self.deactivate_elements(self.elements.lon < W, reason='outside')
+                    outside |= self.elements.lon < W
                 if E is not None:
-                    self.deactivate_elements(self.elements.lon > E, reason='outside')
+                    outside |= self.elements.lon > E
                 if S is not None:
-                    self.deactivate_elements(self.elements.lat < S, reason='outside')
+                    outside |= self.elements.lat < S
                 if N is not None:
-                    self.deactivate_elements(self.elements.lat > N, reason='outside')
+                    outside |= self.elements.lat > N
+                self.deactivate_elements(outside, reason='outside')
                     
  
     
@@ -446,18 +461,18 @@ class BivalveLarvae(OceanDrift):
         self.advect_ocean_current()
 
         # Check for presence in habitat
-        if self.get_config('drift:settlement_in_habitat') is True:
+        if self.settlement_in_habitat is True:
             self.interact_with_habitat()
 
         # Turbulent Mixing or settling-only 
-        if self.get_config('drift:vertical_mixing') is True:
+        if self.vertical_mixing_on is True:
             self.update_terminal_velocity()  #compute vertical velocities, two cases possible - constant, or same as pelagic egg
             self.vertical_mixing()
         else:  # Buoyancy
             self.update_terminal_velocity()
             self.vertical_buoyancy()
 
-        if self.get_config('drift:active_vertical_swimming') is True:
+        if self.active_vertical_swimming is True:
             self.vertical_swimming()
 
         self.vertical_advection()
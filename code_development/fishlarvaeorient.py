@@ -21,10 +21,70 @@ import numpy as np
 from opendrift.models.oceandrift import OceanDrift, Lagrangian3DArray
 import logging; logger = logging.getLogger(__name__)
 from datetime import timezone
-from shapely.geometry import Polygon, Point, MultiPolygon # added for settlement in polygon only
+import shapely
 import fiona # to import habitat
-import random
-from sklearn.neighbors import BallTree
+from scipy.spatial import cKDTree
+import math
+import numba # to compile the orientation kernels
+
+
+# Haversine formula to compute angles during orientation, compiled as a ufunc (computed in double precision for float32 positions)
+@numba.vectorize(['float64(float64, float64, float64, float64)', 'float32(float32, float32, float32, float32)'], target='parallel', fastmath=True)
+def _haversine_angle(lon1, lat1, lon2, lat2):
+	rlat1 = math.radians(float(lat1))
+	rlat2 = math.radians(float(lat2))
+	dlon = math.radians(float(lon2)) - math.radians(float(lon1))
+	X = math.cos(rlat2)*math.sin(dlon)
+	Y = math.cos(rlat1)*math.sin(rlat2)-math.sin(rlat1)*math.cos(rlat2)*math.cos(dlon)
+	return math.atan2(Y,X)
+
+# Horizontal swimming speed (m/s) of the larvae at a given age, presented in Fisher and Bellwood (2003) and used in Staaterman et al. (2012)
+@numba.njit(fastmath=True, cache=True)
+def _swimming_speed(age, hatch_swimming_speed, exponent):
+	return (hatch_swimming_speed + age ** exponent) / 100
+
+# Direction and u,v swimming velocity of the particles orienting toward the habitat (Codling et al., 2004 and Staaterman et al., 2012)
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _orient_velocity_kernel(age, hatch_swimming_speed, exponent, d, theta_pref, theta_current, ti, idx, u_out, v_out):
+	for i in numba.prange(len(idx)):
+		swimming_speed = _swimming_speed(age[idx[i]], hatch_swimming_speed, exponent)
+		# Mean turning angle
+		mu = -d[i] * (theta_current[i] - theta_pref[i])
+		theta = ti[i] - theta_current[i] - mu
+		u_out[idx[i]] = swimming_speed*math.cos(theta)
+		v_out[idx[i]] = swimming_speed*math.sin(theta)
+
+# u,v swimming velocity of the particles swimming toward a cardinal heading
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _cardinal_kernel(age, hatch_swimming_speed, exponent, theta_card, ti, idx, u_out, v_out):
+	for i in numba.prange(len(idx)):
+		swimming_speed = _swimming_speed(age[idx[i]], hatch_swimming_speed, exponent)
+		theta = theta_card + ti[i]
+		u_out[idx[i]] = swimming_speed*math.cos(theta)
+		v_out[idx[i]] = swimming_speed*math.sin(theta)
+
+# u,v swimming velocity of the particles swimming against the currents, no faster than the currents
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _rheotaxis_kernel(age, hatch_swimming_speed, exponent, x_current, y_current, ti, idx, u_out, v_out):
+	for i in numba.prange(len(idx)):
+		swimming_speed = _swimming_speed(age[idx[i]], hatch_swimming_speed, exponent)
+		u_current = x_current[idx[i]]
+		v_current = y_current[idx[i]]
+		theta = -math.atan2(v_current, u_current) + ti[i]
+		uv = math.hypot(u_current, v_current)
+		speed = swimming_speed if abs(swimming_speed) < uv else uv
+		u_out[idx[i]] = speed*math.cos(theta)
+		v_out[idx[i]] = speed*math.sin(theta)
+
+# Cartesian coordinates on the unit sphere, written in the [x, y, z] columns of out
+def unit_sphere_xyz(lon, lat, out):
+	rlat = np.deg2rad(lat)
+	rlon = np.deg2rad(lon)
+	coslat = np.cos(rlat)
+	np.multiply(coslat, np.cos(rlon), out=out[:,0])
+	np.multiply(coslat, np.sin(rlon), out=out[:,1])
+	np.sin(rlat, out=out[:,2])
+	return out
 
 
 class FishLarvaeOrientObj(Lagrangian3DArray):
@@ -113,6 +173,16 @@ class FishLarvaeOrient(OceanDrift):
 		# resuspend larvae that reach seabed by default 
 		self.set_config('general:seafloor_action', 'lift_to_seafloor')
 
+		# [x, y, z] buffer on the unit sphere for the queries of the nearest habitat
+		self.query_buffer = np.empty((0, 3))
+		# [preferred, current] float32 direction buffers for the orientation toward the habitat
+		self.theta_buffer = np.empty((2, 0), dtype=np.float32)
+		# [u, v] float32 buffer for the swimming velocity of the particles
+		self.swimming_buffer = np.empty((2, 0), dtype=np.float32)
+		# Random generator for the orientation, seeded from the global NumPy state
+		# so that np.random.seed() before creating the model still reproduces the run
+		self.rng = np.random.default_rng(np.random.randint(2**32, dtype=np.uint64))
+
 		##add config spec
 		self._add_config({ 'biology:orientation': {'type': 'enum', 'default': 'none',
                 'enum': ['none', 'direct', 'rheotaxis', 'cardinal','continuous_1','continuous_2'],
@@ -217,20 +287,17 @@ class FishLarvaeOrient(OceanDrift):
 		   sea_surface_height > 0 above mean sea level
 		   sea_surface_height < 0 below mean sea level
 		'''
-		if hasattr(self, 'environment') and \
-				hasattr(self.environment, 'sea_surface_height'):
-			if len(self.environment.sea_surface_height) == \
-					self.num_elements_active():
-				sea_surface_height = \
-					self.environment.sea_surface_height
-		if 'sea_surface_height' not in locals():
+		# use the sea surface height already interpolated for the active elements if available
+		sea_surface_height = getattr(getattr(self, 'environment', None), 'sea_surface_height', None)
+		if sea_surface_height is None or \
+				len(sea_surface_height) != self.num_elements_active():
 			env, env_profiles, missing = \
 				self.get_environment(['sea_surface_height'],
 									 time=self.time, lon=self.elements.lon,
 									 lat=self.elements.lat,
 									 z=0*self.elements.lon, profiles=None)
 			sea_surface_height = \
-				env['sea_surface_height'].astype('float32') 
+				env['sea_surface_height'].astype('float32', copy=False) 
 		return sea_surface_height
 	
 	def surface_stick(self):
@@ -242,19 +309,12 @@ class FishLarvaeOrient(OceanDrift):
 		sea_surface_height = self.sea_surface_height() # returns surface elevation at particle positions (>0 above msl, <0 below msl)
 		
 		# keep particle just below sea_surface_height (self.elements.z depth are negative down)
-		surface = np.where(self.elements.z >= sea_surface_height)
-		if len(surface[0]) > 0:
+		surface = self.elements.z >= sea_surface_height
+		if surface.any():
 			self.elements.z[surface] = sea_surface_height[surface] -0.01 # set particle z at 0.01m below sea_surface_height
 	
 	# Haversine formula to compute angles during orientation
-	def haversine_angle(self, lon1, lat1, lon2, lat2):
-		rlat1 = np.deg2rad(lat1)
-		rlat2 = np.deg2rad(lat2)
-		rlon1 = np.deg2rad(lon1)
-		rlon2 = np.deg2rad(lon2)
-		X = np.cos(rlat2)*np.sin(rlon2-rlon1)
-		Y = np.cos(rlat1)*np.sin(rlat2)-np.sin(rlat1)*np.cos(rlat2)*np.cos(rlon2-rlon1)
-		return np.arctan2(Y,X)
+	haversine_angle = staticmethod(_haversine_angle)
 	
 	#####################################################################################################################
 	# Definition of habitat
@@ -262,19 +322,30 @@ class FishLarvaeOrient(OceanDrift):
 	  
 	def habitat(self, shapefile_location):
 		"""Suitable habitat in a shapefile"""
-		polyShp = fiona.open(shapefile_location) # import shapefile
-		polyList = []
-		self.centers_habitat = []
-		rad_centers = []
-		for poly in polyShp: # create individual polygons from shapefile
-			 polyGeom = Polygon(poly['geometry']['coordinates'][0])
-			 polyList.append(polyGeom) # Compile polygon in a list 
-			 self.centers_habitat.append(polyGeom.centroid.coords[0]) # Compute centroid and return a [lon, lat] list
-		for poly in range(len(self.centers_habitat)):
-			rad_centers.append([np.deg2rad(self.centers_habitat[poly][1]),np.deg2rad(self.centers_habitat[poly][0])])
-		self.multiShp = MultiPolygon(polyList).buffer(0) # Aggregate polygons in a MultiPolygon object and buffer to fuse polygons and remove errors
-		self.ball_centers = BallTree(rad_centers, metric='haversine') # Create a Ball Tree with the centroids for faster computation
-		return self.multiShp, self.ball_centers, self.centers_habitat
+		with fiona.open(shapefile_location) as polyShp: # import shapefile, closed once read
+			rings = [np.asarray(poly['geometry']['coordinates'][0]) for poly in polyShp] # exterior ring of each polygon
+		# create all polygons from shapefile in a single call
+		polyList = shapely.polygons(shapely.linearrings(np.concatenate(rings), indices=np.repeat(np.arange(len(rings)), [len(ring) for ring in rings])))
+		polyValid = shapely.make_valid(polyList) # repair polygons with errors
+		centers_habitat = shapely.get_coordinates(shapely.centroid(polyList)) # [lon, lat] array of the centroids
+		# Longitude and latitude of the centroids stored in separate contiguous arrays for vectorized gathers
+		self.centers_lon = np.ascontiguousarray(centers_habitat[:,0], dtype=np.float32)
+		self.centers_lat = np.ascontiguousarray(centers_habitat[:,1], dtype=np.float32)
+		self.multiShp = shapely.unary_union(polyValid) # Fuse the polygons in a single geometry
+		shapely.prepare(self.multiShp) # prepared geometry for the repeated point-in-polygon tests in interact_with_habitat
+		# Create a KD Tree with the centroids on the unit sphere for faster computation
+		# (euclidean chord distance on the sphere gives the same nearest neighbour as the great-circle distance)
+		self.habitat_tree = cKDTree(unit_sphere_xyz(centers_habitat[:,0], centers_habitat[:,1], np.empty((len(centers_habitat), 3))))
+		return self.multiShp, self.habitat_tree, (self.centers_lon, self.centers_lat)
+
+	def find_nearest_habitat(self, lon, lat):
+		'''Great-circle distance (km) and index of the nearest habitat centroid, using a reusable [x, y, z] buffer'''
+		n = len(lat)
+		if len(self.query_buffer) < n: # grow buffer geometrically
+			self.query_buffer = np.empty((max(n, 2*len(self.query_buffer)), 3))
+		chord, habitat_id = self.habitat_tree.query(unit_sphere_xyz(lon, lat, self.query_buffer[:n]), k=1, workers=-1)
+		# Convert chord distance on the unit sphere to great-circle distance
+		return 2*np.arcsin(np.minimum(chord/2, 1.0))*6371, habitat_id
 		
 	#####################################################################################################################
 	# Interaction with environment
@@ -289,29 +360,32 @@ class FishLarvaeOrient(OceanDrift):
 		if 'sea_floor_depth_below_sea_level' not in self.priority_list:
 			return
 		sea_floor_depth = self.sea_floor_depth()
-		below = np.where(self.elements.z < -sea_floor_depth)[0]
+		sea_floor_z = -sea_floor_depth # seafloor elevation, negative down as z
+		below = np.flatnonzero(self.elements.z < sea_floor_z)
 		if len(below) == 0:
 				logger.debug('No elements hit seafloor.')
 				return
 
-		below_and_older = np.logical_and(self.elements.z < -sea_floor_depth, 
-			self.elements.age_seconds >= self.get_config('biology:min_settlement_age_seconds'))
-		below_and_younger = np.logical_and(self.elements.z < -sea_floor_depth, 
-			self.elements.age_seconds < self.get_config('biology:min_settlement_age_seconds'))
+		min_settlement_age = self.get_config('biology:min_settlement_age_seconds')
+		older = self.elements.age_seconds[below] >= min_settlement_age
+		below_and_older = below[older]
+		below_and_younger = below[~older]
 		
 		# Move all elements younger back to seafloor 
 		# (could rather be moved back to previous if relevant? )
-		self.elements.z[np.where(below_and_younger)] = -sea_floor_depth[np.where(below_and_younger)]
+		self.elements.z[below_and_younger] = sea_floor_z[below_and_younger]
 
 		# deactivate elements that were both below and older
 		if self.get_config('biology:settlement_in_habitat') is False:
-			self.deactivate_elements(below_and_older ,reason='settled_on_bottom')
+			settled = np.zeros(len(self.elements.z), dtype=bool)
+			settled[below_and_older] = True
+			self.deactivate_elements(settled ,reason='settled_on_bottom')
 		# if elements can only settle in habitat then they are moved back to seafloor
 		else:
-			self.elements.z[np.where(below_and_older)] = -sea_floor_depth[np.where(below_and_older)]
+			self.elements.z[below_and_older] = sea_floor_z[below_and_older]
 
 		logger.debug('%s elements hit seafloor, %s were older than %s sec. and deactivated, %s were lifted back to seafloor' \
-			% (len(below),len(below_and_older),self.get_config('biology:min_settlement_age_seconds'),len(below_and_younger)))    
+			% (len(below),len(below_and_older),min_settlement_age,len(below_and_younger)))    
 
 	
 	def interact_with_coastline(self,final = False): 
@@ -339,12 +413,13 @@ class FishLarvaeOrient(OceanDrift):
 
 		# if i == 'previous':  # Go back to previous position (in water)
 		# previous_position_if = self.previous_position_if()
+		on_land_mask = self.environment.land_binary_mask == 1 # elements on land, reused below
 		if self.newly_seeded_IDs is not None:
 				self.deactivate_elements(
-					(self.environment.land_binary_mask == 1) &
-					(self.elements.age_seconds == self.time_step.total_seconds()),
+					on_land_mask &
+					np.isin(self.elements.ID, self.newly_seeded_IDs), # elements seeded at this timestep
 					reason='seeded_on_land')
-		on_land = np.where(self.environment.land_binary_mask == 1)[0]
+		on_land = np.flatnonzero(on_land_mask)
 
 			# if previous_position_if is not None:
 			#     self.deactivate_elements((previous_position_if*1 == 1) & (
@@ -359,31 +434,21 @@ class FishLarvaeOrient(OceanDrift):
 		if len(on_land) == 0:
 			logger.debug('No elements hit coastline.')
 		else:
-			if self.get_config('biology:settlement_in_habitat') is True:
-					# Particle can only settle in habitat, set back to previous location
-					logger.debug('%s elements hit coastline, '
-							  'moving back to water' % len(on_land))
-					on_land_ID = self.elements.ID[on_land]
-					self.elements.lon[on_land] = \
-						np.copy(self.previous_lon[on_land_ID - 1])
-					self.elements.lat[on_land] = \
-						np.copy(self.previous_lat[on_land_ID - 1])
-					self.environment.land_binary_mask[on_land] = 0  
-			elif self.get_config('biology:min_settlement_age_seconds') == 0.0 :
-				# No minimum age input, set back to previous position (same as in interact_with_coastline() from basemodel.py)
+			if self.get_config('biology:settlement_in_habitat') is True or self.get_config('biology:min_settlement_age_seconds') == 0.0 :
+				# Particle can only settle in habitat, or no minimum age input: set back to previous position
+				# (same as in interact_with_coastline() from basemodel.py)
 				logger.debug('%s elements hit coastline, '
 						  'moving back to water' % len(on_land))
-				on_land_ID = self.elements.ID[on_land]
-				self.elements.lon[on_land] = \
-					np.copy(self.previous_lon[on_land_ID - 1])
-				self.elements.lat[on_land] = \
-					np.copy(self.previous_lat[on_land_ID - 1])
+				previous_index = self.elements.ID[on_land] - 1 # index of the previous positions of the elements
+				self.elements.lon[on_land] = self.previous_lon[previous_index]
+				self.elements.lat[on_land] = self.previous_lat[previous_index]
 				self.environment.land_binary_mask[on_land] = 0
 			else:
 				#################################
 				# Minimum age before settling was input; check age of particle versus min_settlement_age_seconds
 				# and strand or recirculate accordingly
-				on_land_and_younger = np.where((self.environment.land_binary_mask == 1) & (self.elements.age_seconds < self.get_config('biology:min_settlement_age_seconds')))[0]
+				older = self.elements.age_seconds >= self.get_config('biology:min_settlement_age_seconds')
+				on_land_and_younger = np.flatnonzero(on_land_mask & ~older)
 				#on_land_and_older = np.where((self.environment.land_binary_mask == 1) & (self.elements.age_seconds >= self.get_config('drift:min_settlement_age_seconds')))[0]
 
 				# this step replicates what is done is original code, but accounting for particle age. It seems necessary 
@@ -393,7 +458,7 @@ class FishLarvaeOrient(OceanDrift):
 
 				logger.debug('%s elements hit coastline' % len(on_land))
 				logger.debug('moving %s elements younger than min_settlement_age_seconds back to previous water position' % len(on_land_and_younger))
-				logger.debug('%s elements older than min_settlement_age_seconds remain stranded on coast' % len(on_land_and_younger))
+				logger.debug('%s elements older than min_settlement_age_seconds remain stranded on coast' % (len(on_land) - len(on_land_and_younger)))
 				
 				# refloat elements younger than min_settlement_age back to previous position(s)
 				if len(on_land_and_younger) > 0 :
@@ -401,31 +466,28 @@ class FishLarvaeOrient(OceanDrift):
 					# self.elements.lat[np.where(on_land_and_younger)] = np.copy(self.previous_lat[np.where(on_land_and_younger)])
 					# self.environment.land_binary_mask[on_land_and_younger] = 0 
 
-					self.elements.lon[on_land_and_younger] = np.copy(self.previous_lon[on_land_and_younger_ID - 1])
-					self.elements.lat[on_land_and_younger] = np.copy(self.previous_lat[on_land_and_younger_ID - 1])
+					previous_index = on_land_and_younger_ID - 1
+					self.elements.lon[on_land_and_younger] = self.previous_lon[previous_index]
+					self.elements.lat[on_land_and_younger] = self.previous_lat[previous_index]
 					self.environment.land_binary_mask[on_land_and_younger] = 0
 
 				# deactivate elements older than min_settlement_age & save position
 				# ** function expects an array of size consistent with self.elements.lon
-				self.deactivate_elements((self.environment.land_binary_mask == 1) & \
-										 (self.elements.age_seconds >= self.get_config('biology:min_settlement_age_seconds')),
-										 reason='settled_on_coast')
+				self.deactivate_elements(on_land_mask & older, reason='settled_on_coast')
 					
 	def interact_with_habitat(self):
 		   """Habitat interaction according to configuration setting
 			   The method checks if a particle is within the limit of an habitat before to allow settlement
 		   """        
 		   # Get age of particle
-		   old_enough = np.where(self.elements.age_seconds >= self.get_config('biology:min_settlement_age_seconds'))[0]
+		   old_enough = self.old_enough_settle
 		   # Extract particles positions
 		   if len(old_enough) > 0 :
 			   pts_lon = self.elements.lon[old_enough]
 			   pts_lat = self.elements.lat[old_enough]
-			   for i in range(len(pts_lon)): # => faster version
-				    pt = Point(pts_lon[i], pts_lat[i])
-				    in_habitat = pt.within(self.multiShp)
-				    if in_habitat == True:
-					     self.environment.land_binary_mask[old_enough[i]] = 6
+			   # Check all particles at once against the prepared habitat geometry
+			   in_habitat = shapely.contains_xy(self.multiShp, pts_lon, pts_lat)
+			   self.environment.land_binary_mask[old_enough[in_habitat]] = 6
 						
 		   # Deactivate elements that are within a polygon and old enough to settle
 		   # ** function expects an array of size consistent with self.elements.lon                
@@ -437,175 +499,139 @@ class FishLarvaeOrient(OceanDrift):
 	#####################################################################################################################
 		
 	def reset_horizontal_swimming(self):
-			# Create a  vector for swimming movement
-			self.u_velocity = np.array([0.0]*len(self.elements.lat))
-			self.v_velocity = np.array([0.0]*len(self.elements.lon))
+			# Zero the [u, v] vectors for swimming movement, as views of a buffer reused between timesteps
+			n = len(self.elements.lat)
+			if self.swimming_buffer.shape[1] < n: # grow buffer geometrically
+				self.swimming_buffer = np.empty((2, max(n, 2*self.swimming_buffer.shape[1])), dtype=np.float32)
+			self.u_velocity = self.swimming_buffer[0, :n]
+			self.v_velocity = self.swimming_buffer[1, :n]
+			self.u_velocity.fill(0.0)
+			self.v_velocity.fill(0.0)
 			return self.u_velocity, self.v_velocity
 	
 	
+	def orient_toward_habitat(self, candidates):
+		"""Swimming velocity of the candidate particles that are close enough to orient toward the nearest habitat. 
+		Equations described in Codling et al., 2004 and Staaterman et al., 2012
+		"""
+		max_orient_distance = self.get_config('biology:max_orient_distance')
+		# Distance (km) and index of the nearest habitat for each particle
+		dist_habitat, id_habitat = self.find_nearest_habitat(self.elements.lon[candidates], self.elements.lat[candidates])
+		# Case where particle close enough to orient
+		close_enough = dist_habitat <= max_orient_distance
+		orient = candidates[close_enough]
+		if len(orient) > 0 :
+			pt_lon = self.elements.lon[orient]
+			pt_lat = self.elements.lat[orient]
+			previous_index = self.elements.ID[orient] - 1 # previous positions are stored by element ID
+			pt_lon_old = self.previous_lon[previous_index]
+			pt_lat_old = self.previous_lat[previous_index]
+			# Strength of orientation (depend on distance to the habitat)
+			d = (1 - (dist_habitat[close_enough]/max_orient_distance)).astype(np.float32)
+			n = len(orient)
+			if self.theta_buffer.shape[1] < n: # grow buffer geometrically
+				self.theta_buffer = np.empty((2, max(n, 2*self.theta_buffer.shape[1])), dtype=np.float32)
+			# Compute direction of nearest habitat. See Staaterman et al., 2012
+			theta_pref = self.theta_buffer[0, :n]
+			self.haversine_angle(pt_lon, pt_lat, self.centers_lon[id_habitat[close_enough]], self.centers_lat[id_habitat[close_enough]], out=theta_pref)
+			np.negative(theta_pref, out=theta_pref)
+			# Compute direction from previous timestep
+			theta_current = self.theta_buffer[1, :n]
+			self.haversine_angle(pt_lon_old, pt_lat_old, pt_lon, pt_lat, out=theta_current)
+			# New direction randomly selected in Von Mises distribution
+			ti = self.rng.vonmises(0, 5, size=n).astype(np.float32) # First parameter: mu, second parameter: kappa (control the uncertainty of orientation) 
+
+			# Compute mean turning angle, new direction, and u and v velocity
+			hatch_swimming_speed, exponent = self.swimming_speed_curve()
+			_orient_velocity_kernel(self.elements.age_seconds, hatch_swimming_speed, exponent, d, theta_pref, theta_current, ti, orient, self.u_velocity, self.v_velocity)
+	
+	
 	def direct_orientation_habitat(self):
-		   """"Biased correlated random walk toward the nearest habitat. 
-		   Equations described in Codling et al., 2004 and Staaterman et al., 2012
-		   """
-		   # Check if the particles are old enough to orient
-		   old_enough = np.where(self.elements.age_seconds >= self.get_config('biology:beginning_orientation'))[0]
-		   if len(old_enough) > 0 :
-				    habitat_near, habitat_id = self.ball_centers.query(list(zip(np.deg2rad(self.elements.lat[old_enough]), np.deg2rad(self.elements.lon[old_enough]))), k=1)
-				    for i in range(len(self.elements.lat[old_enough])):
-					    if habitat_near[i][0]*6371 > self.get_config('biology:max_orient_distance'):
-						    pass
-					    else:
-						    pt_lon = self.elements.lon[old_enough][i]
-						    pt_lat = self.elements.lat[old_enough][i]
-						    pt_lon_old = self.previous_lon[old_enough][i]
-						    pt_lat_old = self.previous_lat[old_enough][i]
-						    # Case where particle close enough and old enough to orient
-						    # Strength of orientation (depend on distance to the habitat)
-						    d = 1 - (habitat_near[i][0]*6371/self.get_config('biology:max_orient_distance'))
-						    # Compute direction of nearest habitat. See Staaterman et al., 2012
-						    theta_pref = - self.haversine_angle(pt_lon, pt_lat, self.centers_habitat[habitat_id[i][0]][0], self.centers_habitat[habitat_id[i][0]][1]) 
-						    # Compute direction from previous timestep
-						    theta_current = self.haversine_angle(pt_lon_old, pt_lat_old, pt_lon, pt_lat)
-						    # Mean turning angle
-						    mu = -d * (theta_current - theta_pref)
-						    # New direction randomly selected in Von Mises distribution
-						    ti  = np.random.vonmises(0, 5) # First parameter: mu, second parameter: kappa (control the uncertainty of orientation) 
-						    theta = ti - theta_current - mu
-						
-						    # Compute u and v velocity
-						    self.u_velocity[old_enough[i]] = self.swimming_speed(self.elements.age_seconds[old_enough][i])*np.cos(theta)
-						    self.v_velocity[old_enough[i]] = self.swimming_speed(self.elements.age_seconds[old_enough][i])*np.sin(theta) 
-						    #import pdb; pdb.set_trace()  
-							
-		   self.update_positions(self.u_velocity , self.v_velocity)
+		""""Biased correlated random walk toward the nearest habitat. 
+		Equations described in Codling et al., 2004 and Staaterman et al., 2012
+		"""
+		# Check if the particles are old enough to orient
+		old_enough = self.old_enough_orient
+		if len(old_enough) > 0 :
+			self.orient_toward_habitat(old_enough)
+
+		self.update_positions(self.u_velocity , self.v_velocity)
 	
 	
 	def cardinal_orientation(self):
-			""""Orientation toward a fixed cardinal direction
-			"""
-			# Compute heading
-			thetaCard = np.deg2rad(self.get_config('biology:cardinal_heading'))
-			# Check if the particles are old enough to orient
-			old_enough = np.where(self.elements.age_seconds >= self.get_config('biology:beginning_orientation'))[0]
-			if len(old_enough) > 0 :
-				for i in range(len(self.elements.lat[old_enough])):
-					# Computing preferred direction
-					ti  = np.random.vonmises(0, 5)
-					theta = thetaCard + ti
-				
-					# Compute u and v velocity
-					self.u_velocity[old_enough[i]] = self.swimming_speed(self.elements.age_seconds[old_enough][i])*np.cos(theta)
-					self.v_velocity[old_enough[i]] = self.swimming_speed(self.elements.age_seconds[old_enough][i])*np.sin(theta)
-			
-			self.update_positions(self.u_velocity , self.v_velocity)
+		""""Orientation toward a fixed cardinal direction
+		"""
+		# Compute heading
+		thetaCard = np.deg2rad(self.get_config('biology:cardinal_heading'))
+		# Check if the particles are old enough to orient
+		old_enough = self.old_enough_orient
+		if len(old_enough) > 0 :
+			# Randomness of the preferred direction
+			ti = self.rng.vonmises(0, 5, size=len(old_enough)).astype(np.float32)
+
+			# Compute direction, and u and v velocity
+			hatch_swimming_speed, exponent = self.swimming_speed_curve()
+			_cardinal_kernel(self.elements.age_seconds, hatch_swimming_speed, exponent, thetaCard, ti, old_enough, self.u_velocity, self.v_velocity)
+
+		self.update_positions(self.u_velocity , self.v_velocity)
 		
 	
 	def rheotaxis_orientation(self):
-			""""Orientation against the direction of the local currents
-			"""			
-			# Check if the particles are old enough to orient
-			old_enough = np.where(self.elements.age_seconds >= self.get_config('biology:beginning_orientation'))[0]
-			if len(old_enough) > 0 :			
-				for i in range(len(self.elements.lat[old_enough])):
-					# Compute randomness of direction
-					ti  = np.random.vonmises(0, 5)
-					#Compute rheotaxis heading
-					#import pdb; pdb.set_trace()  
-					thetaRheo = -np.arctan2(self.environment.y_sea_water_velocity[old_enough[i]], self.environment.x_sea_water_velocity[old_enough[i]])
-					theta = thetaRheo + ti
-				
-					# Compute current speed absolute value
-					uv = np.sqrt(self.environment.x_sea_water_velocity[old_enough[i]]**2 + self.environment.y_sea_water_velocity[old_enough[i]]**2)
-					# Compute norm of swimming speed
-					norm_swim = np.abs(self.swimming_speed(self.elements.age_seconds[old_enough][i]))
-				
-					if norm_swim < uv:
-						# Compute u and v velocity
-						self.u_velocity[old_enough[i]] = self.swimming_speed(self.elements.age_seconds[old_enough][i])*np.cos(theta)
-						self.v_velocity[old_enough[i]] = self.swimming_speed(self.elements.age_seconds[old_enough][i])*np.sin(theta)
-					else:
-						self.u_velocity[old_enough[i]] = uv * np.cos(theta)
-						self.v_velocity[old_enough[i]] = uv * np.sin(theta)
-			
-			self.update_positions(self.u_velocity , self.v_velocity)
+		""""Orientation against the direction of the local currents
+		"""
+		# Check if the particles are old enough to orient
+		old_enough = self.old_enough_orient
+		if len(old_enough) > 0 :
+			# Compute randomness of direction
+			ti = self.rng.vonmises(0, 5, size=len(old_enough)).astype(np.float32)
+
+			# Compute rheotaxis heading, and u and v velocity (larvae cannot swim faster than the currents)
+			hatch_swimming_speed, exponent = self.swimming_speed_curve()
+			_rheotaxis_kernel(self.elements.age_seconds, hatch_swimming_speed, exponent, self.environment.x_sea_water_velocity, self.environment.y_sea_water_velocity, ti, old_enough, self.u_velocity, self.v_velocity)
+
+		self.update_positions(self.u_velocity , self.v_velocity)
 
 
 	def mix_orientation(self):
 			"""Continuous orientation of the larvae using either rheotaxis orientation and direct orientation when getting closer to the reefs, 
 			or cardinal orientation and direct orientation when getting closer to the reefs
 				"""
+			orientation = self.get_config('biology:orientation')
 			# Check if the particles are old enough to orient toward the reefs and settle
-			old_enough = np.where(self.elements.age_seconds >= self.get_config('biology:beginning_orientation'))[0]
+			old_enough = self.old_enough_orient
 			if len(old_enough) > 0 :
-				for i in range(len(self.elements.lat[old_enough])):
-					if self.get_config('biology:orientation')=='continuous_1':
-						# Compute randomness of direction
-						ti  = np.random.vonmises(0, 5)
-						#Compute rheotaxis heading
-						thetaRheo = -np.arctan2(self.environment.y_sea_water_velocity[old_enough[i]], self.environment.x_sea_water_velocity[old_enough[i]])
-						theta = thetaRheo + ti
-				
-						# Compute current speed absolute value
-						uv = np.sqrt(self.environment.x_sea_water_velocity[old_enough[i]]**2 + self.environment.y_sea_water_velocity[old_enough[i]]**2)
-						# Compute norm of swimming speed
-						norm_swim = np.abs(self.swimming_speed(self.elements.age_seconds[old_enough][i]))
-				
-						if norm_swim < uv:
-								# Compute u and v velocity
-								self.u_velocity[old_enough[i]] = self.swimming_speed(self.elements.age_seconds[old_enough][i])*np.cos(theta)
-								self.v_velocity[old_enough[i]] = self.swimming_speed(self.elements.age_seconds[old_enough][i])*np.sin(theta)
-						else:
-								self.u_velocity[old_enough[i]] = uv * np.cos(theta)
-								self.v_velocity[old_enough[i]] = uv * np.sin(theta)
-								
-					if self.get_config('biology:orientation')=='continuous_2':
-						# Computing preferred direction
-						thetaCard = np.deg2rad(self.get_config('biology:cardinal_heading'))
-						ti  = np.random.vonmises(0, 5)
-						theta = thetaCard + ti
-				
-						# Compute u and v velocity
-						self.u_velocity[old_enough[i]] = self.swimming_speed(self.elements.age_seconds[old_enough][i])*np.cos(theta)
-						self.v_velocity[old_enough[i]] = self.swimming_speed(self.elements.age_seconds[old_enough][i])*np.sin(theta)
+				# Parameters of the swimming speed curve, evaluated per particle in the kernels
+				hatch_swimming_speed, exponent = self.swimming_speed_curve()
+				if orientation=='continuous_1':
+					# Compute randomness of direction
+					ti = self.rng.vonmises(0, 5, size=len(old_enough)).astype(np.float32)
+					# Compute rheotaxis heading, and u and v velocity (larvae cannot swim faster than the currents)
+					_rheotaxis_kernel(self.elements.age_seconds, hatch_swimming_speed, exponent, self.environment.x_sea_water_velocity, self.environment.y_sea_water_velocity, ti, old_enough, self.u_velocity, self.v_velocity)
+				elif orientation=='continuous_2':
+					# Cardinal heading, and randomness of the preferred direction
+					thetaCard = np.deg2rad(self.get_config('biology:cardinal_heading'))
+					ti = self.rng.vonmises(0, 5, size=len(old_enough)).astype(np.float32)
+					# Compute direction, and u and v velocity
+					_cardinal_kernel(self.elements.age_seconds, hatch_swimming_speed, exponent, thetaCard, ti, old_enough, self.u_velocity, self.v_velocity)
 			
 			# Check if larvae are old enough to go back to the reef to settle
-			looking_for_reef = np.where(self.elements.age_seconds >= self.get_config('biology:min_settlement_age_seconds'))[0]
+			looking_for_reef = self.old_enough_settle
 			if len(looking_for_reef) > 0:
-				# Check if larvae are close enough to detect the reef
-				habitat_near, habitat_id = self.ball_centers.query(list(zip(np.deg2rad(self.elements.lat[looking_for_reef]), np.deg2rad(self.elements.lon[looking_for_reef]))), k=1)
-				for i in range(len(self.elements.lat[looking_for_reef])):
-						if habitat_near[i][0]*6371 < self.get_config('biology:max_orient_distance'):
-							pt_lon = self.elements.lon[looking_for_reef][i]
-							pt_lat = self.elements.lat[looking_for_reef][i]
-							pt_lon_old = self.previous_lon[looking_for_reef][i]
-							pt_lat_old = self.previous_lat[looking_for_reef][i]
-							# Case where particle close enough and old enough to orient
-							# Strength of orientation (depend on distance to the habitat)
-							d = 1 - (habitat_near[i][0]*6371/self.get_config('biology:max_orient_distance'))
-							# Compute direction of nearest habitat. See Staaterman et al., 2012
-							theta_pref = - self.haversine_angle(pt_lon, pt_lat, self.centers_habitat[habitat_id[i][0]][0], self.centers_habitat[habitat_id[i][0]][1]) 
-							# Compute direction from previous timestep
-							theta_current = self.haversine_angle(pt_lon_old, pt_lat_old, pt_lon, pt_lat)
-							# Mean turning angle
-							mu = -d * (theta_current - theta_pref)
-							# New direction randomly selected in Von Mises distribution
-							ti  = np.random.vonmises(0, 5) # First parameter: mu, second parameter: kappa (control the uncertainty of orientation) 
-							theta = ti - theta_current - mu
-						
-							# Compute u and v velocity
-							self.u_velocity[looking_for_reef[i]] = self.swimming_speed(self.elements.age_seconds[looking_for_reef][i])*np.cos(theta)
-							self.v_velocity[looking_for_reef[i]] = self.swimming_speed(self.elements.age_seconds[looking_for_reef][i])*np.sin(theta)
-						
+				# Orientation toward the reef of the larvae close enough to detect it
+				self.orient_toward_habitat(looking_for_reef)
+
 			self.update_positions(self.u_velocity , self.v_velocity)
 	
 	
-	def swimming_speed(self, age):
-			''' Compute horizontal swimming speed of the larvae
-			Presented in Fisher and Bellwood (2003) and used in Staaterman et al. (2012)
-			'''		
-			hor_swimming_speed = (self.get_config('biology:hatch_swimming_speed') + (self.get_config('biology:settle_swimming_speed') - self.get_config('biology:hatch_swimming_speed'))	** (np.log(age)/np.log(self.get_config('drift:max_age_seconds'))) )	/ 100
-			return hor_swimming_speed
-	
+	def swimming_speed_curve(self):
+			''' Hatch swimming speed and exponent of the swimming speed curve, such as
+			hatch + (settle - hatch) ** (log(age)/log(max_age)) == hatch + age ** exponent
+			'''
+			hatch_swimming_speed = self.get_config('biology:hatch_swimming_speed')
+			settle_swimming_speed = self.get_config('biology:settle_swimming_speed')
+			exponent = np.log(settle_swimming_speed - hatch_swimming_speed)/np.log(self.get_config('drift:max_age_seconds'))
+			return hatch_swimming_speed, exponent
+
 	
 	def vertical_swimming(self): # Not used for the moment
 			''' Ontogenetic Vertical Migration. Modified from pelagicplankton_moana.py developed by Simon Weppe
@@ -613,30 +639,21 @@ class FishLarvaeOrient(OceanDrift):
 			Particles will simply go towards their preferred depth.
 			'''
 			vertical_velocity = np.abs(self.get_config('biology:vertical_migration_speed_constant'))  # magnitude in m/s 
-			early_stage = np.where(self.elements.age_seconds < self.get_config('biology:pre_flexion'))[0]
-			if len(early_stage) > 0 :
-				self.elements.terminal_velocity[early_stage] = - np.sign(self.elements.z[early_stage] - self.get_config('biology:depth_early_stage')) * vertical_velocity
-			
-			pre_flexion = np.where((self.elements.age_seconds >= self.get_config('biology:pre_flexion')) & (self.elements.age_seconds < self.get_config('biology:flexion')))[0]
-			if len(pre_flexion) > 0 :
-				self.elements.terminal_velocity[pre_flexion] = - np.sign(self.elements.z[pre_flexion] - self.get_config('biology:depth_pre_flexion')) * vertical_velocity
-			
-			flexion = np.where((self.elements.age_seconds >= self.get_config('biology:flexion')) & (self.elements.age_seconds < self.get_config('biology:post_flexion')))[0]
-			if len(flexion) > 0 :
-				self.elements.terminal_velocity[flexion] = - np.sign(self.elements.z[flexion] - self.get_config('biology:depth_flexion')) * vertical_velocity
-				
-			post_flexion = np.where(self.elements.age_seconds >= self.get_config('biology:post_flexion'))[0]
-			if len(post_flexion) > 0 :
-				self.elements.terminal_velocity[post_flexion] = - np.sign(self.elements.z[post_flexion] - self.get_config('biology:depth_post_flexion')) * vertical_velocity
+			# Stage of each particle from its age (0: early stage, 1: pre-flexion, 2: flexion, 3: post-flexion)
+			stage_ages = np.array([self.get_config('biology:pre_flexion'), self.get_config('biology:flexion'), self.get_config('biology:post_flexion')])
+			stage = np.searchsorted(stage_ages, self.elements.age_seconds, side='right')
+			# Particles swim toward the preferred depth of their stage
+			stage_depths = np.array([self.get_config('biology:depth_early_stage'), self.get_config('biology:depth_pre_flexion'), 
+									 self.get_config('biology:depth_flexion'), self.get_config('biology:depth_post_flexion')])
+			self.elements.terminal_velocity[:] = - np.sign(self.elements.z - stage_depths[stage]) * vertical_velocity
 				
 				
 	def maximum_depth(self):
-		    '''Turn around larvae that are going too deep'''
-		    if self.get_config('drift:maximum_depth') is not None:
-			    too_deep = np.where(self.elements.z < self.get_config('drift:maximum_depth'))[0]
-			    if len(too_deep) > 0:
-				    self.elements.z[too_deep] = self.get_config('drift:maximum_depth')    
-				
+		'''Turn around larvae that are going too deep'''
+		maximum_depth = self.get_config('drift:maximum_depth')
+		if maximum_depth is not None:
+			# clamp the depth in place, in a single pass
+			np.maximum(self.elements.z, maximum_depth, out=self.elements.z)
 
 ###################################################################################################################
 # Pelagic larval duration and mortality
@@ -668,14 +685,16 @@ class FishLarvaeOrient(OceanDrift):
 			# Deacticate any elements outside validity domain set by user
 			if self.validity_domain is not None:
 				W, E, S, N = self.validity_domain
+				outside = np.zeros(len(self.elements.lon), dtype=bool)
 				if W is not None:
-					self.deactivate_elements(self.elements.lon < W, reason='outside')
+					outside |= self.elements.lon < W
 				if E is not None:
-					self.deactivate_elements(self.elements.lon > E, reason='outside')
+					outside |= self.elements.lon > E
 				if S is not None:
-					self.deactivate_elements(self.elements.lat < S, reason='outside')
+					outside |= self.elements.lat < S
 				if N is not None:
-					self.deactivate_elements(self.elements.lat > N, reason='outside')
+					outside |= self.elements.lat > N
+				self.deactivate_elements(outside, reason='outside')
 		   
  
 ###################################################################################################################
@@ -686,22 +705,27 @@ class FishLarvaeOrient(OceanDrift):
 	def update(self):
 		"""Update positions and properties of buoyant particles."""
 
+		# Particles old enough to orient and to settle, found once for the timestep
+		self.old_enough_orient = np.flatnonzero(self.elements.age_seconds >= self.get_config('biology:beginning_orientation'))
+		self.old_enough_settle = np.flatnonzero(self.elements.age_seconds >= self.get_config('biology:min_settlement_age_seconds'))
+
 		## Horizontal advection
 		self.advect_ocean_current() # Independent from age
 		# Orientation behaviors
-		if self.get_config('biology:orientation')=='none':
+		orientation = self.get_config('biology:orientation')
+		if orientation=='none':
 			pass
 		else:
 			self.reset_horizontal_swimming()
-			if self.get_config('biology:orientation')=='direct':
+			if orientation=='direct':
 				self.direct_orientation_habitat() # orientation toward the nearest reef
-			if self.get_config('biology:orientation')=='rheotaxis':
+			if orientation=='rheotaxis':
 				self.rheotaxis_orientation() # orientation against the currents
-			if self.get_config('biology:orientation')=='cardinal':
+			if orientation=='cardinal':
 				self.cardinal_orientation() # orientation toward pre-determined direction
-			if self.get_config('biology:orientation')=='continuous_1':
+			if orientation=='continuous_1':
 				self.mix_orientation() # continuous orientation using rheotaxis and direct orientation
-			if self.get_config('biology:orientation')=='continuous_2':
+			if orientation=='continuous_2':
 				self.mix_orientation() # continuous orientation using cardinal and direct orientation
 		
 		## Update vertical position
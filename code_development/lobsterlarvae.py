@@ -14,10 +14,10 @@ from opendrift.models.oceandrift import OceanDrift, Lagrangian3DArray
 import logging; logger = logging.getLogger(__name__)
 from datetime import timezone
 import fiona
-from shapely.geometry import Polygon, Point, MultiPolygon,asPolygon # added for settlement in polygon only
+from shapely.geometry import Polygon, Point, MultiPolygon # added for settlement in polygon only
 import shapely
 import random
-from sklearn.neighbors import BallTree
+from scipy.spatial import cKDTree
 
 # Defining the  element properties from Pelagicegg model
 class LobsterLarvaeObj(Lagrangian3DArray):
@@ -167,6 +167,12 @@ class LobsterLarvae(OceanDrift):
         X = np.cos(rlat2)*np.sin(rlon2-rlon1)
         Y = np.cos(rlat1)*np.sin(rlat2)-np.sin(rlat1)*np.cos(rlat2)*np.cos(rlon2-rlon1)
         return np.arctan2(Y,X)
+
+    # Cartesian coordinates on the unit sphere, to search the nearest habitat with an euclidean KD Tree
+    def unit_sphere_xyz(self, lon, lat):
+        rlat = np.deg2rad(lat)
+        rlon = np.deg2rad(lon)
+        return np.column_stack((np.cos(rlat)*np.cos(rlon), np.cos(rlat)*np.sin(rlon), np.sin(rlat)))
      
     def calculateMaxSunLight(self):
         # Calculates the max sun radiation at given positions and dates (and returns zero for night time)
@@ -205,13 +211,10 @@ class LobsterLarvae(OceanDrift):
            sea_surface_height > 0 above mean sea level
            sea_surface_height < 0 below mean sea level
         '''
-        if hasattr(self, 'environment') and \
-                hasattr(self.environment, 'sea_surface_height'):
-            if len(self.environment.sea_surface_height) == \
-                    self.num_elements_active():
-                sea_surface_height = \
-                    self.environment.sea_surface_height
-        if 'sea_surface_height' not in locals():
+        # use the sea surface height already interpolated for the active elements if available
+        sea_surface_height = getattr(getattr(self, 'environment', None), 'sea_surface_height', None)
+        if sea_surface_height is None or \
+                len(sea_surface_height) != self.num_elements_active():
             env, env_profiles, missing = \
                 self.get_environment(['sea_surface_height'],
                                      time=self.time, lon=self.elements.lon,
@@ -230,8 +233,8 @@ class LobsterLarvae(OceanDrift):
         sea_surface_height = self.sea_surface_height() # returns surface elevation at particle positions (>0 above msl, <0 below msl)
         
         # keep particle just below sea_surface_height (self.elements.z depth are negative down)
-        surface = np.where(self.elements.z >= sea_surface_height)
-        if len(surface[0]) > 0:
+        surface = self.elements.z >= sea_surface_height
+        if surface.any():
             self.elements.z[surface] = sea_surface_height[surface] -0.01 # set particle z at 0.01m below sea_surface_height
 
 
@@ -276,23 +279,24 @@ class LobsterLarvae(OceanDrift):
       
     def habitat(self, shapefile_location):
         """Suitable habitat in a shapefile"""
-        polyShp = fiona.open(shapefile_location) # import shapefile
         polyList = []
-        self.centers_habitat = []
-        rad_centers = []
-        for poly in polyShp: # create individual polygons from shapefile
-            polyGeom = Polygon(poly['geometry']['coordinates'][0])
-            polyList.append(polyGeom) # Compile polygon in a list 
-            self.centers_habitat.append(polyGeom.centroid.coords[0]) # Compute centroid and return a [lon, lat] list
-        for poly in range(len(self.centers_habitat)):
-            rad_centers.append([np.deg2rad(self.centers_habitat[poly][1]),np.deg2rad(self.centers_habitat[poly][0])])
+        with fiona.open(shapefile_location) as polyShp: # import shapefile, read in a single pass
+            for poly in polyShp: # create individual polygons from shapefile
+                polyList.append(Polygon(poly['geometry']['coordinates'][0])) # Compile polygon in a list 
         self.multiShp = MultiPolygon(polyList).buffer(0) # Aggregate polygons in a MultiPolygon object and buffer to fuse polygons and remove errors
-        self.ball_centers = BallTree(rad_centers, metric='haversine') # Create a Ball Tree with the centroids for faster computation
+        shapely.prepare(self.multiShp) # prepared geometry for the repeated point-in-polygon tests in interact_with_habitat
+        self.centers_habitat = shapely.get_coordinates(shapely.centroid(polyList)) # contiguous [lon, lat] float64 array of the centroids for vectorized indexing
+        # Create a KD Tree with the centroids on the unit sphere for faster computation
+        # (euclidean chord distance on the sphere gives the same nearest neighbour as the great-circle distance)
+        self.ball_centers = cKDTree(self.unit_sphere_xyz(self.centers_habitat[:,0], self.centers_habitat[:,1]))
+        self.centers_habitat = self.centers_habitat.astype(np.float32) # same precision as the particle positions for the orientation
         return self.multiShp, self.ball_centers, self.centers_habitat
 
 
     def find_nearest_habitat(self,lon,lat):
-        return self.ball_centers.query(list(zip(np.deg2rad(lat), np.deg2rad(lon))), k=1)
+        '''Great-circle distance (radians) and index of the nearest habitat centroid, as [n, 1] arrays'''
+        chord, habitat_id = self.ball_centers.query(self.unit_sphere_xyz(lon, lat), k=[1], workers=-1) # queries run in parallel
+        return 2*np.arcsin(np.minimum(chord/2, 1.0)), habitat_id
     
     
 #####################################################################################################################
@@ -308,29 +312,31 @@ class LobsterLarvae(OceanDrift):
         if 'sea_floor_depth_below_sea_level' not in self.priority_list:
             return
         sea_floor_depth = self.sea_floor_depth()
-        below = np.where(self.elements.z < -sea_floor_depth)[0]
-        if len(below) == 0:
+        sea_floor_z = -sea_floor_depth # seafloor elevation, negative down as z
+        below = self.elements.z < sea_floor_z
+        n_below = np.count_nonzero(below)
+        if n_below == 0:
                 logger.debug('No elements hit seafloor.')
                 return
 
-        below_and_older = np.logical_and(self.elements.z < -sea_floor_depth, 
-            self.elements.age_seconds >= self.get_config('biology:min_settlement_age_seconds'))
-        below_and_younger = np.logical_and(self.elements.z < -sea_floor_depth, 
-            self.elements.age_seconds < self.get_config('biology:min_settlement_age_seconds'))
+        min_settlement_age = self.get_config('biology:min_settlement_age_seconds')
+        older = self.elements.age_seconds >= min_settlement_age
+        below_and_older = below & older
+        below_and_younger = below & ~older
         
         # Move all elements younger back to seafloor 
         # (could rather be moved back to previous if relevant? )
-        self.elements.z[np.where(below_and_younger)] = -sea_floor_depth[np.where(below_and_younger)]
+        self.elements.z[below_and_younger] = sea_floor_z[below_and_younger]
 
         # deactivate elements that were both below and older
         if self.get_config('biology:settlement_in_habitat') is False:
             self.deactivate_elements(below_and_older ,reason='settled_on_bottom')
         # if elements can only settle in habitat then they are moved back to seafloor
         else:
-            self.elements.z[np.where(below_and_older)] = -sea_floor_depth[np.where(below_and_older)]
+            self.elements.z[below_and_older] = sea_floor_z[below_and_older]
 
         logger.debug('%s elements hit seafloor, %s were older than %s sec. and deactivated, %s were lifted back to seafloor' \
-            % (len(below),len(below_and_older),self.get_config('biology:min_settlement_age_seconds'),len(below_and_younger)))    
+            % (n_below,np.count_nonzero(below_and_older),min_settlement_age,np.count_nonzero(below_and_younger)))    
 
     
     def interact_with_coastline(self,final = False): 
@@ -341,7 +347,7 @@ class LobsterLarvae(OceanDrift):
              if age_particle < min_settlement_age_seconds : move larvaes back to previous wet position
              if age_particle > min_settlement_age_seconds : larvaes become stranded and will be deactivated.
         """
-        i = self.get_config('general:coastline_action') # will always be 'previous'
+        #i = self.get_config('general:coastline_action') # will always be 'previous'
 
         if not hasattr(self.environment, 'land_binary_mask'):
             return
@@ -358,12 +364,13 @@ class LobsterLarvae(OceanDrift):
 
         # if i == 'previous':  # Go back to previous position (in water)
         # previous_position_if = self.previous_position_if()
+        on_land_mask = self.environment.land_binary_mask == 1 # elements on land, reused below
         if self.newly_seeded_IDs is not None:
                 self.deactivate_elements(
-                    (self.environment.land_binary_mask == 1) &
-                    (self.elements.age_seconds == self.time_step.total_seconds()),
+                    on_land_mask &
+                    np.isin(self.elements.ID, self.newly_seeded_IDs), # elements seeded at this timestep
                     reason='seeded_on_land')
-        on_land = np.where(self.environment.land_binary_mask == 1)[0]
+        on_land = np.flatnonzero(on_land_mask)
 
             # if previous_position_if is not None:
             #     self.deactivate_elements((previous_position_if*1 == 1) & (
@@ -378,32 +385,22 @@ class LobsterLarvae(OceanDrift):
         if len(on_land) == 0:
             logger.debug('No elements hit coastline.')
         else:
-            if self.get_config('biology:settlement_in_habitat') is True:
-                    # Particle can only settle in habitat, set back to previous location
-                    logger.debug('%s elements hit coastline, '
-                              'moving back to water' % len(on_land))
-                    on_land_ID = self.elements.ID[on_land]
-                    self.elements.lon[on_land] = \
-                        np.copy(self.previous_lon[on_land_ID - 1])
-                    self.elements.lat[on_land] = \
-                        np.copy(self.previous_lat[on_land_ID - 1])
-                    self.environment.land_binary_mask[on_land] = 0  
-            elif self.get_config('biology:min_settlement_age_seconds') == 0.0 :
-                # No minimum age input, set back to previous position (same as in interact_with_coastline() from basemodel.py)
+            if self.get_config('biology:settlement_in_habitat') is True or self.get_config('biology:min_settlement_age_seconds') == 0.0 :
+                # Particle can only settle in habitat, or no minimum age input: set back to previous position
+                # (same as in interact_with_coastline() from basemodel.py)
                 logger.debug('%s elements hit coastline, '
                           'moving back to water' % len(on_land))
-                on_land_ID = self.elements.ID[on_land]
-                self.elements.lon[on_land] = \
-                    np.copy(self.previous_lon[on_land_ID - 1])
-                self.elements.lat[on_land] = \
-                    np.copy(self.previous_lat[on_land_ID - 1])
+                previous_index = self.elements.ID[on_land] - 1 # index of the previous positions of the elements
+                self.elements.lon[on_land] = self.previous_lon[previous_index]
+                self.elements.lat[on_land] = self.previous_lat[previous_index]
                 self.environment.land_binary_mask[on_land] = 0
             else:
                 #################################
                 # Minimum age before settling was input; check age of particle versus min_settlement_age_seconds
                 # and strand or recirculate accordingly
-                on_land_and_younger = np.where((self.environment.land_binary_mask == 1) & (self.elements.age_seconds < self.get_config('biology:min_settlement_age_seconds')))[0]
-                on_land_and_older = np.where((self.environment.land_binary_mask == 1) & (self.elements.age_seconds >= self.get_config('biology:min_settlement_age_seconds')))[0]
+                older = self.elements.age_seconds >= self.get_config('biology:min_settlement_age_seconds')
+                on_land_and_younger = np.flatnonzero(on_land_mask & ~older)
+                on_land_and_older = np.flatnonzero(on_land_mask & older)
 
                 # this step replicates what is done is original code, but accounting for particle age. It seems necessary 
                 # to have an array of ID, rather than directly indexing using the "np.where-type" index (in dint64)
@@ -412,7 +409,7 @@ class LobsterLarvae(OceanDrift):
 
                 logger.debug('%s elements hit coastline' % len(on_land))
                 logger.debug('moving %s elements younger than min_settlement_age_seconds back to previous water position' % len(on_land_and_younger))
-                logger.debug('%s elements older than min_settlement_age_seconds remain stranded on coast' % len(on_land_and_younger))
+                logger.debug('%s elements older than min_settlement_age_seconds remain stranded on coast' % len(on_land_and_older))
                 
                 # refloat elements younger than min_settlement_age back to previous position(s)
                 if len(on_land_and_younger) > 0 :
@@ -420,15 +417,14 @@ class LobsterLarvae(OceanDrift):
                     # self.elements.lat[np.where(on_land_and_younger)] = np.copy(self.previous_lat[np.where(on_land_and_younger)])
                     # self.environment.land_binary_mask[on_land_and_younger] = 0 
 
-                    self.elements.lon[on_land_and_younger] = np.copy(self.previous_lon[on_land_and_younger_ID - 1])
-                    self.elements.lat[on_land_and_younger] = np.copy(self.previous_lat[on_land_and_younger_ID - 1])
+                    previous_index = on_land_and_younger_ID - 1
+                    self.elements.lon[on_land_and_younger] = self.previous_lon[previous_index]
+                    self.elements.lat[on_land_and_younger] = self.previous_lat[previous_index]
                     self.environment.land_binary_mask[on_land_and_younger] = 0
 
                 # deactivate elements older than min_settlement_age & save position
                 # ** function expects an array of size consistent with self.elements.lon
-                self.deactivate_elements((self.environment.land_binary_mask == 1) & \
-                                         (self.elements.age_seconds >= self.get_config('biology:min_settlement_age_seconds')),
-                                         reason='settled_on_coast')
+                self.deactivate_elements(on_land_mask & older, reason='settled_on_coast')
                     
     def interact_with_habitat(self):
            """Habitat interaction according to configuration setting
@@ -440,12 +436,9 @@ class LobsterLarvae(OceanDrift):
            if len(old_enough) > 0 :
                pts_lon = self.elements.lon[old_enough]
                pts_lat = self.elements.lat[old_enough]
-               ## Check if position of particle is within boundaries of polygons => slow version because loop over polygons
-               for i in range(len(pts_lon)): # => faster version
-                    pt = Point(pts_lon[i], pts_lat[i])
-                    in_habitat = pt.within(self.multiShp)
-                    if in_habitat == True:
-                        self.environment.land_binary_mask[old_enough[i]] = 6
+               ## Check if position of particle is within boundaries of polygons, all particles at once against the prepared habitat geometry
+               in_habitat = shapely.contains_xy(self.multiShp, pts_lon, pts_lat)
+               self.environment.land_binary_mask[old_enough[in_habitat]] = 6
            # Deactivate elements that are within a polygon and old enough to settle
            # ** function expects an array of size consistent with self.elements.lon                
            self.deactivate_elements((self.environment.land_binary_mask == 6), reason='settled_on_habitat')
@@ -467,7 +460,6 @@ class LobsterLarvae(OceanDrift):
             Direct orientation, where the larvae swim toward the nearest reef. 
             Biased correlated random walk toward the nearest habitat. 
             Equations described in Codling et al., 2004 and Staaterman et al., 2012
-            ** Algorithm could be vectorized to optimize speed (instead of looping through each particle)
             """
             # Replaced by metamorphosis step where larvae have a transformation step
             # Check if the particles are old enough to orient
@@ -479,47 +471,44 @@ class LobsterLarvae(OceanDrift):
             if len(puerulus) > 0 :
                 # find closest habitat distance, and its index
                 habitat_near, habitat_id = self.find_nearest_habitat(self.elements.lon[puerulus],self.elements.lat[puerulus])
-                # old_close_enough = np.where( (self.elements.age_seconds >= self.get_config('biology:age_beginning_orientation')) & \
-                #                              (habitat_near.ravel()*6371. < self.get_config('biology:max_orient_distance')) )[0]
-                close_enough = (habitat_near.ravel()*6371. < self.get_config('biology:max_orient_distance')) # 6371km is earth radius 
+                close_enough = (habitat_near[:,0]*6371 <= self.get_config('biology:max_orient_distance')) # 6371km is earth radius 
                 logger.debug('Larvae : direct orientation of puerulus - moving %s particles towards nearest reef' % (close_enough.sum()))
 
                 #cur_dir_rad = self.get_current_direction() # not used for the lobster larvae
 
-                # looping through each particle - could be vectorized
-                for i in range(len(self.elements.lat[puerulus])):
-                    if habitat_near[i][0]*6371 > self.get_config('biology:max_orient_distance'):
-                        pass
-                    else:
-                        pt_lon = self.elements.lon[puerulus][i]
-                        pt_lat = self.elements.lat[puerulus][i]
-                        pt_lon_old = self.previous_lon[puerulus][i]
-                        pt_lat_old = self.previous_lat[puerulus][i]
-                        # Case where particle is old enough and close enough from habitat to orient
-                        # Strength of orientation (depend on distance to the habitat). Eq. 3 Staaterman et al., 2012
-                        dist = 1 - (habitat_near[i][0]*6371/self.get_config('biology:max_orient_distance')) # 
-                        # Compute direction of nearest habitat. See Staaterman et al., 2012
-                        theta_pref = - self.haversine_angle(pt_lon, pt_lat, self.centers_habitat[habitat_id[i][0]][0], self.centers_habitat[habitat_id[i][0]][1]) 
-                        # Compute current direction from previous timestep
-                        # ** note this will include the swimming-induced motions from past timestep as well
-                        theta_current = self.haversine_angle(pt_lon_old, pt_lat_old, pt_lon, pt_lat) # from previous positions 
-                        # theta_current = cur_dir_rad[old_enough[i]] # from ambient current direction
-                        # Mean turning angle, Eq. 2 Staaterman et al., 2012
-                        mu = -dist * (theta_current - theta_pref)
-                        # Define larvae swimming direction
-                        # direction uncertainty drawn from Von Mises distribution : First parameter: mu, second parameter: kappa
-                        ti  = np.random.vonmises(0, 5) #  (control the uncertainty of orientation)
-                        # final larvae swimming direction
-                        theta = ti - theta_current - mu
-                        # Compute u and v swim velocity component
-                        self.elements.u_swim[puerulus[i]] = self.swimming_speed()*np.cos(theta)
-                        self.elements.v_swim[puerulus[i]] = self.swimming_speed()*np.sin(theta)
+                # Case where particle is old enough and close enough from habitat to orient
+                orient = np.flatnonzero(close_enough)
+                if len(orient) > 0:
+                    swimmers = puerulus[orient]
+                    pt_lon = self.elements.lon[swimmers]
+                    pt_lat = self.elements.lat[swimmers]
+                    # Strength of orientation (depend on distance to the habitat). Eq. 3 Staaterman et al., 2012
+                    dist = 1 - (habitat_near[orient,0].astype(np.float32)*6371/self.get_config('biology:max_orient_distance')) # 
+                    # Compute direction of nearest habitat. See Staaterman et al., 2012
+                    theta_pref = - self.haversine_angle(pt_lon, pt_lat, self.centers_habitat[habitat_id[orient,0], 0], self.centers_habitat[habitat_id[orient,0], 1]) 
+                    # Compute current direction from previous timestep
+                    # ** note this will include the swimming-induced motions from past timestep as well
+                    previous_index = self.elements.ID[swimmers] - 1 # previous positions are stored by element ID
+                    # previous positions are kept in float64, cast them like the current positions so the trig stays in float32
+                    theta_current = self.haversine_angle(self.previous_lon[previous_index].astype(np.float32), self.previous_lat[previous_index].astype(np.float32), pt_lon, pt_lat) # from previous positions  
+                    # theta_current = cur_dir_rad[old_enough] # from ambient current direction
+                    # Mean turning angle, Eq. 2 Staaterman et al., 2012
+                    mu = -dist * (theta_current - theta_pref)
+                    # Define larvae swimming direction
+                    # direction uncertainty drawn from Von Mises distribution : First parameter: mu, second parameter: kappa
+                    ti  = np.random.vonmises(0, 5, size=len(swimmers)).astype(np.float32) #  (control the uncertainty of orientation)
+                    # final larvae swimming direction
+                    theta = ti - theta_current - mu
+                    # Compute u and v swim velocity component, in a single assignment for all the particles
+                    swimming_speed = self.swimming_speed(size=len(swimmers)).astype(np.float32)
+                    self.elements.u_swim[swimmers] = swimming_speed*np.cos(theta)
+                    self.elements.v_swim[swimmers] = swimming_speed*np.sin(theta)
 
             logger.debug('    %.5f [m/s] =< u_swim <=  %.5f [m/s]' % (np.min(self.elements.u_swim),np.max(self.elements.u_swim))) 
             logger.debug('    %.5f [m/s] =< v_swim <=  %.5f [m/s]' % (np.min(self.elements.u_swim),np.max(self.elements.u_swim))) 
             self.update_positions(self.elements.u_swim , self.elements.v_swim)
 
-    def swimming_speed(self):
+    def swimming_speed(self, size=None):
             # Compute swimming speed of larvae - no dependence on age 
             # beta distribution to reproduce the findings in Jeffs and Hollands 2000 (speeds from 13 and 22cm/s with outlier at 30.7cm/s) 
             # and Wilkin and Jeffs 2011 (model predictions btwn 13 and 16cm/s) (mean = 1/(1+B/A) => 16.8cm/s here with a=2 and b=8)
@@ -529,7 +518,7 @@ class LobsterLarvae(OceanDrift):
             # Jeffs and Hollands,2000,Swimming behaviour of the puerulus of the spiny lobster, Jasus edwardsii.Crustaceana 73(7):847-856
             Vmin = self.get_config('biology:min_swimming_speed_puerulus')
             Vmax = self.get_config('biology:max_swimming_speed_puerulus')
-            swimming_speed = ( Vmin + np.random.beta(2, 8) * (Vmax-Vmin) ) / 100
+            swimming_speed = ( Vmin + np.random.beta(2, 8, size=size) * (Vmax-Vmin) ) / 100 # one speed per particle when size is given
             return swimming_speed
    
     def get_current_direction(self):
@@ -591,9 +580,11 @@ class LobsterLarvae(OceanDrift):
         mid_stage_phyllosoma =  np.where( (self.elements.age_seconds >= self.get_config('biology:mid_stage_phyllosoma')) &	(self.elements.age_seconds <= self.get_config('biology:late_stage_phyllosoma')) )[0]
         logger.debug('Larvae : checking phyllosoma distance to shore - %s particles in mid to late_stage_phyllosoma' % (len(mid_stage_phyllosoma)))
         if len(mid_stage_phyllosoma) > 0:
-            for i in range(len(self.elements.lon[mid_stage_phyllosoma])):
-                pt_lon = self.elements.lon[mid_stage_phyllosoma][i]
-                pt_lat = self.elements.lat[mid_stage_phyllosoma][i] 
+            lon_phyllosoma = self.elements.lon[mid_stage_phyllosoma]
+            lat_phyllosoma = self.elements.lat[mid_stage_phyllosoma]
+            for i in range(len(mid_stage_phyllosoma)):
+                pt_lon = lon_phyllosoma[i]
+                pt_lat = lat_phyllosoma[i] 
                 # Remove phyllosoma found 20km inshore, or any other habitats defined by user (habitat_near[i]*6371 = distance in km)
                 lon_circle ,lat_circle = self.get_circle(pt_lon, pt_lat, 20e3) 
                 # check if any land points within the 20km radius
@@ -637,14 +628,16 @@ class LobsterLarvae(OceanDrift):
             # Deacticate any elements outside validity domain set by user
             if self.validity_domain is not None:
                 W, E, S, N = self.validity_domain
+                outside = np.zeros(len(self.elements.lon), dtype=bool)
                 if W is not None:
-                    self.deactivate_elements(self.elements.lon < W, reason='outside')
+                    outside |= self.elements.lon < W
                 if E is not None:
-                    self.deactivate_elements(self.elements.lon > E, reason='outside')
+                    outside |= self.elements.lon > E
                 if S is not None:
-                    self.deactivate_elements(self.elements.lat < S, reason='outside')
+                    outside |= self.elements.lat < S
                 if N is not None:
-                    self.deactivate_elements(self.elements.lat > N, reason='outside')
+                    outside |= self.elements.lat > N
+                self.deactivate_elements(outside, reason='outside')
 
 
 ###################################################################################################################